@@ -0,0 +1,218 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+
+__author__      = 'Roy Gardner'
+__copyright__   = 'Copyright 2025, Roy Gardner and Sally Gardner'
+
+"""
+Inverted-file (IVF) index for similarity range queries, i.e., "all segments with similarity >= t".
+
+The index is built by the processing pipeline (see build_ann_index() in processing/utilities.py) and saved as
+ann_index.npz next to the model. Corpus segments are partitioned into lists around unit centroids and each list
+records the largest angle between its centroid and a member. By the triangle inequality on the sphere a list can
+only contain a match if the angle between the query and the centroid, less the list radius, is within the threshold
+angle. Probing every such list gives exact results. Capping the number of lists probed per query trades recall for
+speed which is what the recall report measures.
+
+If a model has no index the brute-force scan of the similarity engine is used.
+"""
+
+from packages import *
+from similarity import cosine_threshold,get_similarity_engine
+
+class RangeIndex:
+    """
+    IVF range index over the segment encodings.
+    """
+    def __init__(self,centroids,order,offsets,min_cosines,engine,max_lists=0):
+        """
+        param centroids: Unit centroid vectors, one row per list.
+        param order: Corpus row indices grouped by list.
+        param offsets: List l holds order[offsets[l]:offsets[l+1]].
+        param min_cosines: Smallest cosine similarity between each centroid and its members.
+        param engine: SimilarityEngine for the model.
+        param max_lists: Maximum lists probed per query vector. 0 probes every list that can hold a match (exact).
+        """
+        self.centroids = np.asarray(centroids,dtype=np.float32)
+        self.order = np.asarray(order,dtype=np.int64)
+        self.offsets = np.asarray(offsets,dtype=np.int64)
+        self.radii = np.arccos(np.clip(np.asarray(min_cosines,dtype=np.float64),-1.0,1.0))
+        self.engine = engine
+        self.max_lists = max_lists
+
+    @classmethod
+    def load(cls,filename,engine,max_lists=0):
+        """
+        Load an index written by the processing pipeline.
+        param filename: Path to ann_index.npz.
+        param engine: SimilarityEngine for the model.
+        param max_lists: See __init__.
+        return: A RangeIndex
+        """
+        with np.load(filename) as data:
+            return cls(data['centroids'],data['order'],data['offsets'],data['min_cosines'],engine,max_lists=max_lists)
+
+    def probes(self,vectors,threshold,max_lists=None):
+        """
+        Find the lists to probe for each query vector.
+        param vectors: Matrix of unit query vectors.
+        param threshold: Angular similarity threshold.
+        param max_lists: Overrides the index max_lists if not None.
+        return: Boolean matrix with a row per query vector and a column per list.
+        """
+        if max_lists is None:
+            max_lists = self.max_lists
+        angles = np.arccos(np.clip(vectors @ self.centroids.T,-1.0,1.0))
+        # Lower bound on the angle between a query and any member of a list. The small tolerance
+        # absorbs float32 rounding so that exact probing stays exact.
+        bounds = angles - self.radii
+        probe = bounds <= np.pi * (1.0 - threshold) + 1e-5
+        if max_lists > 0 and max_lists < probe.shape[1]:
+            nearest = np.argsort(bounds,axis=1)[:,:max_lists]
+            capped = np.zeros_like(probe)
+            np.put_along_axis(capped,nearest,True,axis=1)
+            probe &= capped
+        return probe
+
+    def max_cosine_hits(self,vectors,threshold,max_lists=None):
+        """
+        Find corpus segments whose angular similarity to at least one vector is at or above threshold, together with
+        their best cosine similarity to the vectors, e.g., for ThresholdResult.from_hits().
+        param vectors: Matrix of unit query vectors.
+        param threshold: Angular similarity threshold.
+        param max_lists: Overrides the index max_lists if not None.
+        return: Tuple of a sorted array of corpus row indices and an array of their cosines
+        """
+        found = [np.array([],dtype=np.int64)]
+        found_cosines = [np.array([],dtype=np.float32)]
+        if len(vectors) > 0:
+            probe = self.probes(vectors,threshold,max_lists=max_lists)
+            cos_threshold = cosine_threshold(threshold)
+            for l in np.flatnonzero(probe.any(axis=0)):
+                members = self.order[self.offsets[l]:self.offsets[l+1]]
+                if len(members) == 0:
+                    continue
+                cosines = np.max(vectors[probe[:,l]] @ self.engine.rows(members).T,axis=0)
+                above = cosines >= cos_threshold
+                found.append(members[above])
+                found_cosines.append(cosines[above])
+        indices = np.concatenate(found)
+        order = np.argsort(indices,kind='stable')
+        return indices[order],np.concatenate(found_cosines)[order].astype(np.float32)
+
+    def hits(self,vectors,threshold,max_lists=None):
+        """
+        Find corpus segments whose angular similarity to at least one vector is at or above threshold.
+        param vectors: Matrix of unit query vectors.
+        param threshold: Angular similarity threshold.
+        param max_lists: Overrides the index max_lists if not None.
+        return: Sorted array of corpus row indices.
+        """
+        return self.max_cosine_hits(vectors,threshold,max_lists=max_lists)[0]
+
+    def scanned(self,vectors,threshold,max_lists=None):
+        """
+        Number of corpus segments scored by a query, i.e., the work done relative to a brute-force scan.
+        param vectors: Matrix of unit query vectors.
+        param threshold: Angular similarity threshold.
+        param max_lists: Overrides the index max_lists if not None.
+        return: Number of corpus segments scored.
+        """
+        probe = self.probes(vectors,threshold,max_lists=max_lists)
+        return int(np.sum(np.diff(self.offsets)[probe.any(axis=0)]))
+
+def load_ann_index(model_path,model_dict,max_lists=0,sample_size=64):
+    """
+    Load the model's ANN index if the processing pipeline built one and it matches the encodings.
+    An index left by an earlier build of the model is ignored with a warning. It is detected by lists that don't hold
+    every corpus row exactly once or by members of a sample that lie outside their list's radius.
+    param model_path: Path to the model files.
+    param model_dict: Application data model.
+    param max_lists: See RangeIndex.
+    param sample_size: Number of corpus rows checked against their list.
+    return: A RangeIndex or None
+    """
+    filename = model_path + 'ann_index.npz'
+    if not os.path.exists(filename):
+        return None
+    engine = get_similarity_engine(model_dict)
+    n = len(engine)
+    index = RangeIndex.load(filename,engine,max_lists=max_lists)
+    order,offsets = index.order,index.offsets
+    if len(order) != n or offsets[0] != 0 or offsets[-1] != n or np.any(np.diff(offsets) < 0) or \
+       index.centroids.shape[1] != engine.encodings.shape[1] or \
+       np.any(np.bincount(order,minlength=n) != 1):
+        print(f'Warning: the ANN index ({len(order)} rows) does not match the segment encodings ({n} rows) and is '\
+              'ignored. Please reprocess the model.')
+        return None
+    if n > 0:
+        positions = np.unique(np.linspace(0,n - 1,min(sample_size,n)).astype(np.int64))
+        lists = np.searchsorted(offsets,positions,side='right') - 1
+        cosines = np.einsum('ij,ij->i',engine.rows(order[positions]),index.centroids[lists])
+        if np.any(np.arccos(np.clip(cosines,-1.0,1.0)) > index.radii[lists] + 1e-3):
+            print('Warning: the ANN index was built from different segment encodings and is ignored. '\
+                  'Please reprocess the model.')
+            return None
+    return index
+
+def range_search(vectors,threshold,model_dict):
+    """
+    Find corpus segments similar to one or more vectors, using the model's ANN index if it has one and
+    falling back to a brute-force scan otherwise.
+    param vectors: Matrix of unit query vectors.
+    param threshold: Angular similarity threshold.
+    param model_dict: Application data model.
+    return: Sorted array of corpus row indices.
+    """
+    if model_dict.get('ann_index') is not None:
+        return model_dict['ann_index'].hits(vectors,threshold)
+    return get_similarity_engine(model_dict).hits(vectors,threshold)
+
+def ann_recall_report(model_dict,thresholds=[0.6,0.68,0.76,0.84],query_count=50,max_lists=None,seed=0,verbose=True):
+    """
+    Compare ANN range queries with the exact brute-force scan. Queries are randomly chosen corpus segments.
+    param model_dict: Application data model with an ann_index.
+    param thresholds: Similarity thresholds to test.
+    param query_count: Number of query segments.
+    param max_lists: Overrides the index max_lists if not None.
+    param seed: Random seed for choosing query segments.
+    param verbose: Print the report if True.
+    return: A dictionary keyed by threshold containing recall, fraction of corpus scanned, and timings
+    """
+    index = model_dict['ann_index']
+    engine = get_similarity_engine(model_dict)
+    rng = np.random.default_rng(seed)
+    query_indices = rng.choice(len(engine),size=min(query_count,len(engine)),replace=False)
+    vectors = engine.rows(query_indices)
+
+    report = {}
+    for threshold in thresholds:
+        found_count = 0
+        exact_count = 0
+        scanned = 0
+        exact_time = 0.0
+        index_time = 0.0
+        for vector in vectors:
+            vector = vector[None,:]
+            t1 = time.time()
+            exact = engine.hits(vector,threshold)
+            t2 = time.time()
+            found = index.hits(vector,threshold,max_lists=max_lists)
+            t3 = time.time()
+            exact_time += t2 - t1
+            index_time += t3 - t2
+            exact_count += len(exact)
+            found_count += len(np.intersect1d(exact,found,assume_unique=True))
+            scanned += index.scanned(vector,threshold,max_lists=max_lists)
+        report[threshold] = {
+            'recall': found_count / exact_count if exact_count > 0 else 1.0,
+            'scanned': scanned / (len(vectors) * len(engine)),
+            'exact_time': exact_time / len(vectors),
+            'index_time': index_time / len(vectors)
+        }
+    if verbose:
+        print('Threshold  Recall  Scanned  Exact (ms)  Index (ms)')
+        for threshold,row in report.items():
+            print(f"{threshold:9.2f}  {row['recall']:6.3f}  {row['scanned']:7.3f}  "
+                  f"{row['exact_time'] * 1000:10.2f}  {row['index_time'] * 1000:10.2f}")
+    return report
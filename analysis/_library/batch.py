@@ -0,0 +1,362 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+
+__author__      = 'Roy Gardner'
+__copyright__   = 'Copyright 2025, Roy Gardner and Sally Gardner'
+
+"""
+Headless batch SAT runs.
+
+Runs the notebook's SAT process (generation, expansion iterations, and review) for many topics against one loaded
+model without the checkbox server. Choices that a user makes by checking segments are made by an acceptance policy:
+
+- ScoreCutoffPolicy accepts segments whose angular similarity to the topic formulation is at or above a cutoff.
+- ReplayPolicy replays the seed, accept, and review choices recorded in existing session logs or resource files.
+
+Other policies can be written by subclassing AcceptancePolicy. Topics run in parallel on a pool of threads that
+share the model's encodings and result cache. Results are written in the same session log and CSV format as the
+notebook. See batch_sat.py in the analysis folder for the command line interface.
+"""
+
+from packages import *
+from utilities import encode_text,get_segment_indices
+from similarity import angular_similarity,get_similarity_engine
+from query_cache import cached_encoder
+from result_cache import get_result_cache
+from sat import run_sat_generation,get_generation_results,run_sat_expansion,cluster_sat_candidates,accept_review
+from session_log import SessionLog,load_resource_dict,session_topic_keys
+
+# Defaults of the notebook interface sliders
+DEFAULT_TOPIC = {
+    'topic_label': '',
+    'topic_description': '',
+    'search_threshold': 0.63,
+    'cluster_threshold': 0.72,
+    'mapping_threshold': 0.70,
+    'expansion_cluster_threshold': 0.74,
+    'review_cluster_threshold': 0.74
+}
+
+def segment_ids_of(segments):
+    """
+    Get the segment IDs of a list of {segment_id: text} dictionaries as stored in resource files.
+    param segments: List of dictionaries.
+    return: A set of segment IDs
+    """
+    return set([key for d in segments for key in d.keys()])
+
+class AcceptancePolicy(ABC):
+    """
+    Makes the choices a user makes in the notebook. Each method is passed a context dictionary containing the
+    topic, the model_dict, the unit query_vectors of the topic formulation, the iteration number, and the
+    cluster_dict of the segments being chosen from, as listed to a user by list_clusters().
+    Subclasses implement seed() and accept().
+    """
+    def prepare(self,topic):
+        """
+        Complete a topic before it is run, e.g., with thresholds from a previous run.
+        param topic: Topic dictionary.
+        return: Topic dictionary
+        """
+        return topic
+
+    @abstractmethod
+    def seed(self,segment_ids,context):
+        """
+        Select the SAT seed set from the generation search results.
+        param segment_ids: Set of segment IDs found by the search.
+        param context: Context dictionary.
+        return: A set of segment IDs
+        """
+
+    @abstractmethod
+    def accept(self,candidate_ids,context):
+        """
+        Select the candidates accepted in an expansion iteration. The remainder are rejected.
+        param candidate_ids: Set of candidate segment IDs.
+        param context: Context dictionary.
+        return: A set of segment IDs
+        """
+
+    def review(self,sat_segment_ids,context):
+        """
+        Select the segments kept in review.
+        param sat_segment_ids: Set of SAT segment IDs.
+        param context: Context dictionary.
+        return: A set of segment IDs
+        """
+        return set(sat_segment_ids)
+
+class ScoreCutoffPolicy(AcceptancePolicy):
+    """
+    Accepts segments whose angular similarity to the topic formulation is at or above a cutoff.
+    """
+    def __init__(self,cutoff=0.75,seed_cutoff=None,review_cutoff=None):
+        """
+        param cutoff: Angular similarity cutoff for expansion candidates.
+        param seed_cutoff: Cutoff for generation results. Defaults to cutoff.
+        param review_cutoff: Cutoff applied in review. If None every SAT segment is kept.
+        """
+        self.cutoff = cutoff
+        self.seed_cutoff = seed_cutoff if seed_cutoff is not None else cutoff
+        self.review_cutoff = review_cutoff
+
+    def scores(self,segment_ids,context):
+        """
+        Score segments by their best angular similarity to the formulation vectors.
+        param segment_ids: List of segment IDs.
+        param context: Context dictionary.
+        return: Vector of scores in the order of segment_ids
+        """
+        if len(segment_ids) == 0:
+            return np.zeros(0)
+        engine = get_similarity_engine(context['model_dict'])
+        rows = engine.rows(get_segment_indices(segment_ids,context['model_dict']))
+        return angular_similarity(np.max(context['query_vectors'] @ rows.T,axis=0))
+
+    def select(self,segment_ids,context,cutoff):
+        segment_ids = sorted(segment_ids)
+        scores = self.scores(segment_ids,context)
+        return set([segment_id for segment_id,score in zip(segment_ids,scores) if score >= cutoff])
+
+    def seed(self,segment_ids,context):
+        return self.select(segment_ids,context,self.seed_cutoff)
+
+    def accept(self,candidate_ids,context):
+        return self.select(candidate_ids,context,self.cutoff)
+
+    def review(self,sat_segment_ids,context):
+        if self.review_cutoff is None:
+            return set(sat_segment_ids)
+        return self.select(sat_segment_ids,context,self.review_cutoff)
+
+class ReplayPolicy(AcceptancePolicy):
+    """
+    Replays the choices recorded in session logs or resource files written by the notebook or a previous batch run.
+    Seeds are the recorded seed set, a candidate is accepted if it was accepted in any recorded iteration or is in the
+    final SAT, and review removes the recorded removed segments. Thresholds and formulations are taken from the
+    recorded run unless the topic sets them.
+    """
+    def __init__(self,resource_path='./outputs/'):
+        """
+        param resource_path: Folder containing <topic_key>_session.jsonl or <topic_key>_resource.json files.
+        """
+        self.resource_path = resource_path
+        self.resources = {}
+
+    def resource(self,topic_key):
+        """
+        Load the resources dictionary of a topic.
+        param topic_key: Topic key.
+        return: A resources dictionary
+        """
+        if not topic_key in self.resources:
+            self.resources[topic_key] = load_resource_dict(topic_key,self.resource_path)
+        return self.resources[topic_key]
+
+    def prepare(self,topic):
+        resource_dict = self.resource(topic['topic_key'])
+        recorded = {
+            'formulation': resource_dict['generation']['formulation'],
+            'topic_label': resource_dict['topic_label'],
+            'topic_description': resource_dict['topic_description'],
+            'search_threshold': resource_dict['generation']['search_threshold'],
+            'cluster_threshold': resource_dict['generation']['cluster_threshold']
+        }
+        iterations = resource_dict['expansion']['iterations']
+        if len(iterations) > 0:
+            recorded['mapping_threshold'] = iterations[0]['mapping_threshold']
+            recorded['expansion_cluster_threshold'] = iterations[0]['cluster_threshold']
+        recorded.update(topic)
+        return recorded
+
+    def seed(self,segment_ids,context):
+        resource_dict = self.resource(context['topic']['topic_key'])
+        return segment_ids_of(resource_dict['generation']['seed_segments'])
+
+    def accept(self,candidate_ids,context):
+        resource_dict = self.resource(context['topic']['topic_key'])
+        accepted_ids = segment_ids_of(resource_dict['review']['sat_segments_final'])
+        accepted_ids.update(segment_ids_of(resource_dict['review']['removed_segments']))
+        for iteration_dict in resource_dict['expansion']['iterations']:
+            accepted_ids.update(segment_ids_of(iteration_dict['accepted_set']))
+        return set(candidate_ids).intersection(accepted_ids)
+
+    def review(self,sat_segment_ids,context):
+        resource_dict = self.resource(context['topic']['topic_key'])
+        return set(sat_segment_ids).difference(segment_ids_of(resource_dict['review']['removed_segments']))
+
+def load_topics(filename):
+    """
+    Load topics from a JSON list of dictionaries or a CSV file with a header row. Each topic has a topic_key and,
+    unless its choices are replayed, a formulation. Other fields are the keys of DEFAULT_TOPIC.
+    param filename: Path to a .json or .csv file.
+    return: A list of topic dictionaries
+    """
+    if filename.endswith('.csv'):
+        with open(filename,'r',encoding='utf-8') as f:
+            topics = [dict(row) for row in csv.DictReader(f)]
+    else:
+        with open(filename,'r',encoding='utf-8') as f:
+            topics = json.load(f)
+    for topic in topics:
+        for key,value in list(topic.items()):
+            if key.endswith('_threshold') and isinstance(value,str):
+                topic[key] = float(value)
+    return topics
+
+def replay_topics(resource_path='./outputs/'):
+    """
+    List the topics recorded in a folder of resource files, e.g., to replay all of them.
+    param resource_path: Folder containing <topic_key>_session.jsonl or <topic_key>_resource.json files.
+    return: A list of topic dictionaries
+    """
+    return [{'topic_key':topic_key} for topic_key in session_topic_keys(resource_path)]
+
+def prepare_topic(topic,policy):
+    """
+    Complete a topic with the policy's fields and the defaults of the notebook sliders.
+    param topic: Topic dictionary, see load_topics().
+    param policy: An AcceptancePolicy.
+    return: A new topic dictionary
+    """
+    topic = policy.prepare(dict(topic))
+    for key,value in DEFAULT_TOPIC.items():
+        topic.setdefault(key,value)
+    if len(topic['topic_label']) == 0:
+        topic['topic_label'] = topic['topic_key']
+    return topic
+
+def run_sat_topic(topic,model_dict,encoder,policy,output_path='./outputs/',max_iterations=50,prepared=False,\
+                  verbose=False):
+    """
+    Run the SAT process for one topic: generation, expansion iterations until no candidates are accepted or none are
+    found, and review. The session log and final SAT CSV are written to output_path.
+    Progress lines are prefixed with the topic key so that the output of topics run in parallel can be told apart.
+    param topic: Topic dictionary, see load_topics().
+    param model_dict: Application data model.
+    param encoder: Model used to generate encoding of the search formulation.
+    param policy: An AcceptancePolicy.
+    param output_path: Folder the results are written to.
+    param max_iterations: Maximum number of expansion iterations.
+    param prepared: True if topic has already been completed by prepare_topic().
+    param verbose: Print progress if True.
+    return: A summary dictionary with set sizes and timings
+    """
+    if not prepared:
+        topic = prepare_topic(topic,policy)
+    session_log = SessionLog(topic['topic_key'],output_path)
+    session_log.generation(topic['formulation'],topic['search_threshold'],topic['cluster_threshold'])
+    timings = {}
+
+    # Generation
+    t1 = time.time()
+    engine = get_similarity_engine(model_dict)
+    query_vectors = engine.normalise(encode_text([topic['formulation']],cached_encoder(encoder)))
+    context = {'topic':topic,'model_dict':model_dict,'query_vectors':query_vectors,'iteration':0}
+    choice_dict = {'topic_key':topic['topic_key'],'formulation':topic['formulation'],\
+                   'search_threshold':topic['search_threshold'],'cluster_threshold':topic['cluster_threshold']}
+    segment_ids = run_sat_generation(choice_dict,model_dict,encoder)
+    context['cluster_dict'] = cluster_sat_candidates(segment_ids,model_dict,threshold=topic['cluster_threshold']) \
+                              if len(segment_ids) > 0 else {}
+    sat_segment_ids = policy.seed(segment_ids,context)
+    session_log.seed(sat_segment_ids)
+    timings['generation'] = time.time() - t1
+
+    # Expansion
+    t1 = time.time()
+    rejected_segment_ids = set()
+    sat_candidate_ids = set()
+    if len(sat_segment_ids) > 0:
+        sat_candidate_ids = run_sat_expansion(sat_segment_ids,sat_segment_ids,rejected_segment_ids,model_dict,\
+                                              threshold=topic['mapping_threshold'])
+    iteration = 0
+    while len(sat_candidate_ids) > 0 and iteration < max_iterations:
+        iteration += 1
+        context['iteration'] = iteration
+        context['cluster_dict'] = cluster_sat_candidates(sat_candidate_ids,model_dict,\
+                                                         threshold=topic['expansion_cluster_threshold'])
+        sat_accepted_ids = policy.accept(sat_candidate_ids,context)
+        new_rejected_ids = sat_candidate_ids.difference(sat_accepted_ids).difference(rejected_segment_ids)
+        sat_segment_ids.update(sat_accepted_ids)
+        rejected_segment_ids.update(new_rejected_ids)
+        session_log.iteration(sat_accepted_ids,new_rejected_ids,set(),topic['mapping_threshold'],\
+                              topic['expansion_cluster_threshold'])
+        if len(sat_accepted_ids) == 0:
+            # Termination condition
+            break
+        sat_candidate_ids = run_sat_expansion(sat_accepted_ids,sat_segment_ids,rejected_segment_ids,model_dict,\
+                                              threshold=topic['mapping_threshold'])
+        if verbose:
+            print(f"{topic['topic_key']}: iteration {iteration} accepted {len(sat_accepted_ids)}, "
+                  f"{len(sat_candidate_ids)} new candidates")
+    timings['expansion'] = time.time() - t1
+
+    # Review
+    t1 = time.time()
+    review_sat_ids = set(sat_segment_ids)
+    context['cluster_dict'] = cluster_sat_candidates(review_sat_ids,model_dict,\
+                                                     threshold=topic['review_cluster_threshold']) \
+                              if len(review_sat_ids) > 0 else {}
+    sat_segment_ids = policy.review(review_sat_ids,context)
+    if len(sat_segment_ids) > 0:
+        file_name = accept_review(topic['topic_label'],topic['topic_description'],sat_segment_ids,review_sat_ids,\
+                                  session_log,model_dict,output_path=output_path,verbose=False)
+        if verbose:
+            print(f"{topic['topic_key']}: final SAT of {len(sat_segment_ids)} segments written to {file_name}")
+    timings['review'] = time.time() - t1
+
+    return {
+        'topic_key': topic['topic_key'],
+        'search_results': len(segment_ids),
+        'seed_segments': len(session_log.state['seed_ids']),
+        'iterations': iteration,
+        'rejected_segments': len(rejected_segment_ids),
+        'final_segments': len(sat_segment_ids),
+        'timings': timings
+    }
+
+def run_sat_batch(topics,model_dict,encoder,policy,output_path='./outputs/',workers=4,verbose=True):
+    """
+    Run the SAT process for many topics in parallel. Workers are threads so every topic shares the model's memory-mapped
+    encodings and result cache. Similarity computations release the GIL so topics run concurrently.
+    param topics: List of topic dictionaries.
+    param model_dict: Application data model.
+    param encoder: Model used to generate encoding of the search formulations.
+    param policy: An AcceptancePolicy.
+    param output_path: Folder the results are written to.
+    param workers: Number of worker threads.
+    param verbose: Print the progress of each topic and a summary table if True.
+    return: A list of summary dictionaries in the order of topics
+    """
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+    # Shared state is created before the workers start
+    get_result_cache(model_dict)
+    get_similarity_engine(model_dict)
+
+    t1 = time.time()
+    # Every formulation is encoded and searched in one batch so topics start with their search results cached
+    topics = [prepare_topic(topic,policy) for topic in topics]
+    get_generation_results([topic['formulation'] for topic in topics],model_dict,encoder)
+    search_time = time.time() - t1
+
+    t1 = time.time()
+    with ThreadPoolExecutor(max_workers=max(1,workers)) as executor:
+        futures = [executor.submit(run_sat_topic,topic,model_dict,encoder,policy,output_path=output_path,\
+                                   prepared=True,verbose=verbose) for topic in topics]
+        summaries = [future.result() for future in futures]
+    elapsed = time.time() - t1
+
+    if verbose:
+        print()
+        print(f'{"Topic":30s} {"Search":>7s} {"Seed":>6s} {"Iter":>5s} {"Final":>6s} {"Gen (s)":>8s} '
+              f'{"Exp (s)":>8s} {"Rev (s)":>8s}')
+        for summary in summaries:
+            timings = summary['timings']
+            print(f"{summary['topic_key'][:30]:30s} {summary['search_results']:7d} {summary['seed_segments']:6d} "
+                  f"{summary['iterations']:5d} {summary['final_segments']:6d} {timings['generation']:8.2f} "
+                  f"{timings['expansion']:8.2f} {timings['review']:8.2f}")
+        print(f'{len(summaries)} topics in {search_time + elapsed:.2f}s with {workers} workers '
+              f'({search_time:.2f}s batched search).')
+    return summaries
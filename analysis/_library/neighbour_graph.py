@@ -0,0 +1,104 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+
+__author__      = 'Roy Gardner'
+__copyright__   = 'Copyright 2025, Roy Gardner and Sally Gardner'
+
+"""
+Precomputed corpus neighbour graph.
+
+The processing pipeline can store every pair of segments whose angular similarity is at or above the lowest slider
+threshold as a sparse CSR matrix of cosine similarities (see build_neighbour_graph() in processing/utilities.py).
+Self pairs are not stored since every segment is its own neighbour with a cosine of 1.
+Pairwise similarities never change for a given model so SAT expansion becomes a lookup of the rows of the map
+segments followed by a threshold filter rather than a similarity scan of the corpus.
+"""
+
+from packages import *
+from similarity import cosine_threshold
+
+class NeighbourGraph:
+    """
+    Sparse graph of corpus segment pairs at or above a minimum angular similarity.
+    """
+    def __init__(self,graph,min_threshold):
+        """
+        param graph: CSR matrix of cosine similarities with a row and a column per corpus segment.
+        param min_threshold: Angular similarity threshold used to build the graph.
+        """
+        self.graph = graph
+        self.min_threshold = min_threshold
+
+    @classmethod
+    def load(cls,filename):
+        """
+        Load a graph written by the processing pipeline.
+        param filename: Path to neighbour_graph.npz.
+        return: A NeighbourGraph
+        """
+        with np.load(filename) as data:
+            graph = csr_matrix((data['data'],data['indices'],data['indptr']),shape=tuple(data['shape']))
+            return cls(graph,float(data['min_threshold']))
+
+    def covers(self,threshold):
+        """
+        Check whether the graph holds every pair at or above a threshold.
+        param threshold: Angular similarity threshold.
+        return: True if the graph can answer queries at threshold
+        """
+        return threshold >= self.min_threshold
+
+    def hits(self,indices,threshold):
+        """
+        Find corpus segments whose angular similarity to at least one of the segments in indices is at or above threshold.
+        param indices: Corpus row indices.
+        param threshold: Angular similarity threshold, not less than min_threshold.
+        return: Sorted array of corpus row indices.
+        """
+        indices = np.asarray(indices,dtype=np.int64)
+        rows = self.graph[indices]
+        return np.union1d(rows.indices[rows.data >= cosine_threshold(threshold)],indices).astype(np.int64)
+
+    def max_cosine(self,indices):
+        """
+        Best cosine similarity of each corpus segment to any of the segments in indices.
+        Segments that are not neighbours of any of the segments in indices are given a cosine of -1.
+        param indices: Corpus row indices.
+        return: Vector with an entry per corpus segment.
+        """
+        indices = np.asarray(indices,dtype=np.int64)
+        rows = self.graph[indices]
+        max_cosines = np.full(self.graph.shape[1],-1.0,dtype=np.float32)
+        np.maximum.at(max_cosines,rows.indices,rows.data)
+        max_cosines[indices] = 1.0
+        return max_cosines
+
+def load_neighbour_graph(model_path,engine,sample_size=64):
+    """
+    Load the model's neighbour graph if the processing pipeline built one and it matches the encodings.
+    A graph left by an earlier build of the model is ignored with a warning. It is detected by its shape or by the
+    cosines stored for a sample of pairs.
+    param model_path: Path to the model files.
+    param engine: SimilarityEngine for the model.
+    param sample_size: Number of stored pairs whose cosines are checked.
+    return: A NeighbourGraph or None
+    """
+    filename = model_path + 'neighbour_graph.npz'
+    if not os.path.exists(filename):
+        return None
+    neighbour_graph = NeighbourGraph.load(filename)
+    graph = neighbour_graph.graph
+    if graph.shape != (len(engine),len(engine)):
+        print(f'Warning: the neighbour graph ({graph.shape[0]} rows) does not match the segment encodings '\
+              f'({len(engine)} rows) and is ignored. Please reprocess the model.')
+        return None
+    if graph.nnz > 0:
+        positions = np.unique(np.linspace(0,graph.nnz - 1,min(sample_size,graph.nnz)).astype(np.int64))
+        rows = np.searchsorted(graph.indptr,positions,side='right') - 1
+        cols = graph.indices[positions]
+        cosines = np.einsum('ij,ij->i',engine.rows(rows),engine.rows(cols))
+        if not np.allclose(cosines,graph.data[positions],atol=1e-4):
+            print('Warning: the neighbour graph was built from different segment encodings and is ignored. '\
+                  'Please reprocess the model.')
+            return None
+    return neighbour_graph
@@ -3,10 +3,16 @@
 
 import angular_distance as ad
 
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 import copy
+import argparse
 import csv
 from datetime import datetime, timedelta
 
+import hashlib
 import html
 from IPython.core.display import HTML
 from ipywidgets import interact, interactive, fixed, interact_manual
@@ -18,14 +24,12 @@ from IPython.display import Javascript
 
 from itertools import combinations,permutations
 
+import importlib
+import importlib.util
 import json
 from lxml import etree
 import math
-import matplotlib.pyplot as plt
-from matplotlib_venn import venn2, venn2_circles
-from matplotlib_venn import venn3, venn3_circles
 
-import networkx as nx
 import numpy as np
 import os
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3' 
@@ -34,22 +38,120 @@ import random
 import re
 
 import scipy as sp
-from scipy import stats
 from scipy.spatial.distance import *
 from scipy.sparse import csr_matrix
 from scipy.sparse.csgraph import connected_components
 
+import sqlite3
 import string
-
-import tensorflow as tf
-import tensorflow_hub as hub
-import tensorflow_text
+import subprocess
+import sys
 
 import time
 
+# Heavy modules are imported on first use so that opening a notebook and loading a model doesn't wait for
+# TensorFlow, networkx, or matplotlib. TensorFlow is only imported when an encoder is loaded.
+
+# Seconds taken by each lazy import in this session
+lazy_import_times = {}
+
+class LazyModule:
+    """
+    Proxy for a module that is imported the first time one of its attributes is used.
+    """
+    def __init__(self,name,requires=[]):
+        """
+        param name: Module name, e.g., 'matplotlib.pyplot'.
+        param requires: Names of modules imported first, e.g., modules that register TensorFlow ops.
+        """
+        self._name = name
+        self._requires = requires
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            for name in self._requires:
+                lazy_modules[name]._load()
+            t1 = time.time()
+            self._module = importlib.import_module(self._name)
+            lazy_import_times[self._name] = time.time() - t1
+        return self._module
+
+    def __getattr__(self,attribute):
+        # Special attributes are looked up by copy, pickle, and IPython without the module being needed
+        if attribute.startswith('__'):
+            raise AttributeError(attribute)
+        return getattr(self._load(),attribute)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return f"<lazy module '{self._name}' ({state})>"
+
+lazy_modules = {}
+for name,requires in [('tensorflow',[]),('tensorflow_text',['tensorflow']),\
+                      ('tensorflow_hub',['tensorflow','tensorflow_text']),('networkx',[]),\
+                      ('matplotlib.pyplot',[]),('matplotlib_venn',[]),('scipy.stats',[])]:
+    lazy_modules[name] = LazyModule(name,requires=requires)
+
+tf = lazy_modules['tensorflow']
+tensorflow_text = lazy_modules['tensorflow_text']
+hub = lazy_modules['tensorflow_hub']
+nx = lazy_modules['networkx']
+plt = lazy_modules['matplotlib.pyplot']
+stats = lazy_modules['scipy.stats']
+
+def venn2(*args,**kwargs):
+    return lazy_modules['matplotlib_venn'].venn2(*args,**kwargs)
+
+def venn2_circles(*args,**kwargs):
+    return lazy_modules['matplotlib_venn'].venn2_circles(*args,**kwargs)
+
+def venn3(*args,**kwargs):
+    return lazy_modules['matplotlib_venn'].venn3(*args,**kwargs)
+
+def venn3_circles(*args,**kwargs):
+    return lazy_modules['matplotlib_venn'].venn3_circles(*args,**kwargs)
+
+def import_report():
+    """
+    Print the cost of importing each library dependency, measured with python -X importtime in a fresh interpreter so
+    that modules already imported by this session are included, and whether the module is loaded in this session.
+    return: A dictionary with module names as keys and cumulative import times in seconds as values
+    """
+    eager = ['numpy','scipy.sparse','scipy.sparse.csgraph','scipy.spatial.distance','lxml.etree','ipywidgets',\
+             'IPython.display','angular_distance']
+    lazy = list(lazy_modules)
+    report = {}
+    for name in eager + lazy:
+        # Each module is timed in its own interpreter so that shared dependencies are counted for every module
+        result = subprocess.run([sys.executable,'-X','importtime','-c',f'import {name}'],capture_output=True,\
+                                text=True,cwd=os.path.dirname(os.path.abspath(ad.__file__)))
+        times = [line.split('|') for line in result.stderr.splitlines() if line.startswith('import time:')]
+        times = [int(fields[1]) for fields in times if len(fields) == 3 and fields[1].strip().isdigit() and \
+                 fields[2].strip() == name]
+        report[name] = times[-1] / 1e6 if len(times) > 0 else None
+
+    print(f'{"Module":28s} {"Import (s)":>10s}  {"When":6s}  Loaded in this session')
+    for name,seconds in report.items():
+        when = 'eager' if name in eager else 'lazy'
+        if name in lazy_import_times:
+            loaded = f'yes ({lazy_import_times[name]:.2f}s)'
+        else:
+            loaded = 'yes' if name in sys.modules else 'no'
+        cost = f'{seconds:10.2f}' if seconds is not None else f'{"failed":>10s}'
+        print(f'{name:28s} {cost}  {when:6s}  {loaded}')
+    eager_total = sum([report[name] or 0.0 for name in eager])
+    lazy_total = sum([report[name] or 0.0 for name in lazy])
+    print(f'Eager imports {eager_total:.2f}s. Deferred imports {lazy_total:.2f}s.')
+    return report
+
 from http.server import HTTPServer, BaseHTTPRequestHandler
 from IPython.display import HTML
 import socket
-from threading import Thread
+from threading import Lock, Thread
 
 import urllib
+import urllib.request
@@ -0,0 +1,170 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+
+__author__      = 'Roy Gardner'
+__copyright__   = 'Copyright 2025, Roy Gardner and Sally Gardner'
+
+"""
+Persistent cache of query embeddings.
+
+Topic formulations are re-encoded whenever a generation is re-run, e.g., with a different threshold or after a
+kernel restart. Formulation encodings are stored in an SQLite database keyed by encoder version and text so that
+repeat searches don't call the encoder. Since the notebook encoder is a LazyEncoder, a search whose formulation is
+in the cache doesn't import TensorFlow at all. The least recently used entries are evicted once the cache holds more
+than max_entries encodings. Cache hits are only written to the database in batches, so a cached search doesn't
+commit a transaction.
+"""
+
+from packages import *
+from server import get_encoder_version
+
+QUERY_CACHE_PATH = './cache/query_embeddings.sqlite'
+
+class QueryEmbeddingCache:
+    """
+    Least recently used on-disk cache of encodings keyed by encoder version and text.
+    """
+    def __init__(self,filename=QUERY_CACHE_PATH,max_entries=100000,flush_size=256,flush_interval=60.0):
+        """
+        param filename: Path to the SQLite database, which is created if it doesn't exist.
+        param max_entries: Maximum number of cached encodings.
+        param flush_size: Number of pending last used times at which they are written.
+        param flush_interval: Seconds after which pending last used times are written on the next hit.
+        """
+        self.filename = filename
+        self.max_entries = max_entries
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.hits = 0
+        self.misses = 0
+        # Last used times of hits keyed by (encoder, text) that have not been written yet
+        self.pending = {}
+        self.flush_time = time.time()
+        self.lock = Lock()
+        directory = os.path.dirname(os.path.abspath(filename))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        # Batch searches may encode from worker threads so access is serialised by the lock
+        self.connection = sqlite3.connect(filename,check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS queries (encoder TEXT, text TEXT, encoding BLOB, '\
+                                'last_used REAL, PRIMARY KEY (encoder, text)) WITHOUT ROWID')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS queries_last_used ON queries (last_used)')
+        self.connection.commit()
+
+    def get(self,encoder,text):
+        """
+        Get a cached encoding and mark it as recently used. The last used time is written with the next put() or
+        once flush_size hits or flush_interval seconds have accumulated.
+        param encoder: Encoder version.
+        param text: Query text.
+        return: Encoding vector or None
+        """
+        with self.lock:
+            row = self.connection.execute('SELECT encoding FROM queries WHERE encoder = ? AND text = ?',\
+                                          (encoder,text)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            now = time.time()
+            self.pending[(encoder,text)] = now
+            if len(self.pending) >= self.flush_size or now - self.flush_time >= self.flush_interval:
+                self.write_pending()
+                self.connection.commit()
+            return np.frombuffer(row[0],dtype=np.float32)
+
+    def write_pending(self):
+        """
+        Write pending last used times. Called with the lock held and followed by a commit.
+        """
+        if len(self.pending) > 0:
+            self.connection.executemany('UPDATE queries SET last_used = ? WHERE encoder = ? AND text = ?',\
+                                        [(used,encoder,text) for (encoder,text),used in self.pending.items()])
+            self.pending = {}
+        self.flush_time = time.time()
+
+    def flush(self):
+        """
+        Write pending last used times, e.g., before the database is copied.
+        """
+        with self.lock:
+            self.write_pending()
+            self.connection.commit()
+
+    def put(self,encoder,texts,encodings):
+        """
+        Store encodings and evict least recently used entries beyond max_entries.
+        param encoder: Encoder version.
+        param texts: List of query texts.
+        param encodings: Matrix with an encoding per text.
+        """
+        now = time.time()
+        rows = [(encoder,text,np.asarray(encoding,dtype=np.float32).tobytes(),now) \
+                for text,encoding in zip(texts,encodings)]
+        with self.lock:
+            # Pending hits are written first so that eviction sees their last used times
+            self.write_pending()
+            self.connection.executemany('INSERT OR REPLACE INTO queries VALUES (?, ?, ?, ?)',rows)
+            count = self.connection.execute('SELECT COUNT(*) FROM queries').fetchone()[0]
+            if count > self.max_entries:
+                self.connection.execute('DELETE FROM queries WHERE (encoder, text) IN (SELECT encoder, text '\
+                                        'FROM queries ORDER BY last_used LIMIT ?)',(count - self.max_entries,))
+            self.connection.commit()
+
+# Query caches opened in this session keyed by database path
+query_caches = {}
+
+def get_query_cache(filename=QUERY_CACHE_PATH):
+    """
+    Get the query cache stored in a database, opening it if needed.
+    param filename: Path to the SQLite database.
+    return: A QueryEmbeddingCache
+    """
+    if not filename in query_caches:
+        query_caches[filename] = QueryEmbeddingCache(filename)
+    return query_caches[filename]
+
+class CachedEncoder:
+    """
+    Encoder wrapper that serves encodings from a QueryEmbeddingCache and only calls the encoder for texts that are
+    not cached. Instances are called like the encoder they wrap.
+    """
+    def __init__(self,encoder,encoder_version,cache):
+        """
+        param encoder: The encoder, e.g., a LazyEncoder.
+        param encoder_version: Encoder version used in cache keys, see get_encoder_version().
+        param cache: A QueryEmbeddingCache.
+        """
+        self.encoder = encoder
+        self.encoder_version = encoder_version
+        self.cache = cache
+
+    def __call__(self,text_list):
+        """
+        Encode texts.
+        param text_list: A list of strings.
+        return: A float32 matrix with an encoding per string
+        """
+        encodings = [self.cache.get(self.encoder_version,text) for text in text_list]
+        missing = [i for i,encoding in enumerate(encodings) if encoding is None]
+        if len(missing) > 0:
+            texts = [text_list[i] for i in missing]
+            new_encodings = np.asarray(self.encoder(texts),dtype=np.float32)
+            self.cache.put(self.encoder_version,texts,new_encodings)
+            for i,encoding in zip(missing,new_encodings):
+                encodings[i] = encoding
+        if len(encodings) == 0:
+            return np.zeros((0,0),dtype=np.float32)
+        return np.stack(encodings)
+
+def cached_encoder(encoder,filename=QUERY_CACHE_PATH):
+    """
+    Wrap an encoder with the query cache. Encoders are identified by their encoder_path attribute, which
+    LazyEncoder and RemoteEncoder have, so other encoders are returned unwrapped.
+    param encoder: The encoder.
+    param filename: Path to the query cache database.
+    return: A CachedEncoder or encoder
+    """
+    if isinstance(encoder,CachedEncoder) or getattr(encoder,'encoder_path',None) is None:
+        return encoder
+    return CachedEncoder(encoder,get_encoder_version(encoder.encoder_path),get_query_cache(filename))
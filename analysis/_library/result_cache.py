@@ -0,0 +1,205 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+
+__author__      = 'Roy Gardner'
+__copyright__   = 'Copyright 2025, Roy Gardner and Sally Gardner'
+
+"""
+Threshold-indexed cache of generation, expansion, and clustering results.
+
+For each query (a formulation or a set of SAT segments) the best cosine similarity of every corpus segment above
+the lowest slider threshold is stored as a sorted array. The result set for any slider threshold is then a binary
+search rather than a full recompute, and the number of results at each threshold can be shown before a threshold
+is chosen. Likewise the above-threshold pairs of a segment set are stored sorted by similarity so that clustering
+at a new threshold is a single connected components pass. Entries are evicted least recently used first when the
+cache exceeds its memory budget.
+"""
+
+from packages import *
+from similarity import cosine_threshold
+
+# Lowest threshold offered by the generation and expansion sliders
+MIN_THRESHOLD = 0.58
+MAX_THRESHOLD = 0.9
+
+# Lowest threshold offered by the cluster sliders
+MIN_CLUSTER_THRESHOLD = 0.6
+
+def slider_thresholds(min_threshold=MIN_THRESHOLD,max_threshold=MAX_THRESHOLD,step=0.01):
+    """
+    The thresholds a slider can take.
+    return: A list of thresholds rounded to two decimal places
+    """
+    count = int(round((max_threshold - min_threshold) / step)) + 1
+    return [round(min_threshold + i * step,2) for i in range(count)]
+
+class ThresholdResult:
+    """
+    The corpus rows found by a query, sorted by their best cosine similarity to the query.
+    """
+    def __init__(self,max_cosines,min_threshold=MIN_THRESHOLD):
+        """
+        param max_cosines: Best cosine similarity to the query for every corpus row.
+        param min_threshold: Rows below this angular similarity threshold are not stored.
+        """
+        self.min_threshold = min_threshold
+        indices = np.flatnonzero(max_cosines >= cosine_threshold(min_threshold))
+        order = np.argsort(max_cosines[indices],kind='stable')
+        self.indices = indices[order]
+        self.cosines = np.asarray(max_cosines[self.indices],dtype=np.float32)
+
+    @classmethod
+    def from_hits(cls,indices,cosines,min_threshold=MIN_THRESHOLD):
+        """
+        Create a result from the rows at or above min_threshold and their cosines, e.g., from range_cosines().
+        param indices: Corpus row indices.
+        param cosines: Cosine similarity of each row to the query.
+        param min_threshold: Angular similarity threshold used to find the rows.
+        return: A ThresholdResult
+        """
+        result = cls.__new__(cls)
+        result.min_threshold = min_threshold
+        order = np.argsort(cosines,kind='stable')
+        result.indices = np.asarray(indices,dtype=np.int64)[order]
+        result.cosines = np.asarray(cosines,dtype=np.float32)[order]
+        return result
+
+    @property
+    def nbytes(self):
+        return self.indices.nbytes + self.cosines.nbytes
+
+    def at(self,threshold):
+        """
+        Get the rows at or above a threshold.
+        param threshold: Angular similarity threshold, not less than min_threshold.
+        return: Array of corpus row indices
+        """
+        if threshold < self.min_threshold:
+            raise ValueError(f'Threshold {threshold} is below the cached minimum of {self.min_threshold}')
+        position = np.searchsorted(self.cosines,cosine_threshold(threshold),side='left')
+        return self.indices[position:]
+
+    def counts(self,thresholds=None,exclude_indices=None):
+        """
+        Count the rows at or above each threshold.
+        param thresholds: List of thresholds. Defaults to the slider thresholds.
+        param exclude_indices: Optional rows that are not counted, e.g., SAT and rejected segments.
+        return: A dictionary with thresholds as keys and counts as values
+        """
+        if thresholds is None:
+            thresholds = slider_thresholds(min_threshold=self.min_threshold)
+        cosines = self.cosines
+        if exclude_indices is not None and len(exclude_indices) > 0:
+            cosines = cosines[~np.isin(self.indices,exclude_indices)]
+        positions = np.searchsorted(cosines,cosine_threshold(np.asarray(thresholds)),side='left')
+        return {threshold:int(len(cosines) - position) for threshold,position in zip(thresholds,positions)}
+
+class EdgeResult:
+    """
+    The above-threshold pairs of a segment set, sorted by cosine similarity, so that the set can be re-clustered at
+    any threshold without recomputing pairwise similarities.
+    """
+    def __init__(self,segment_ids,rows,cols,cosines,min_threshold=MIN_CLUSTER_THRESHOLD):
+        """
+        param segment_ids: List of segment IDs. Pairs refer to positions in this list.
+        param rows: First position of each pair.
+        param cols: Second position of each pair.
+        param cosines: Cosine similarity of each pair.
+        param min_threshold: Angular similarity threshold used to find the pairs.
+        """
+        self.segment_ids = segment_ids
+        self.min_threshold = min_threshold
+        order = np.argsort(cosines,kind='stable')
+        self.rows = rows[order]
+        self.cols = cols[order]
+        self.cosines = np.asarray(cosines[order],dtype=np.float32)
+
+    @property
+    def nbytes(self):
+        return self.rows.nbytes + self.cols.nbytes + self.cosines.nbytes
+
+    def at(self,threshold):
+        """
+        Get the pairs at or above a threshold.
+        param threshold: Angular similarity threshold, not less than min_threshold.
+        return: Tuple of arrays of first and second positions
+        """
+        if threshold < self.min_threshold:
+            raise ValueError(f'Threshold {threshold} is below the cached minimum of {self.min_threshold}')
+        position = np.searchsorted(self.cosines,cosine_threshold(threshold),side='left')
+        return self.rows[position:],self.cols[position:]
+
+class ResultCache:
+    """
+    Least recently used cache of ThresholdResult and EdgeResult objects bounded by a memory budget.
+    """
+    def __init__(self,memory_budget=512 * 1024 * 1024):
+        """
+        param memory_budget: Maximum number of bytes held by cached results.
+        """
+        self.memory_budget = memory_budget
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        # Batch runs share the cache between worker threads
+        self.lock = Lock()
+
+    def __contains__(self,key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self,key):
+        """
+        Get a cached result and mark it as most recently used.
+        param key: Cache key.
+        return: A ThresholdResult, EdgeResult, or None
+        """
+        with self.lock:
+            if not key in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self,key,result):
+        """
+        Add a result, evicting least recently used results to stay within the memory budget.
+        param key: Cache key.
+        param result: A ThresholdResult or EdgeResult.
+        """
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= self.entries.pop(key).nbytes
+            self.entries[key] = result
+            self.nbytes += result.nbytes
+            while self.nbytes > self.memory_budget and len(self.entries) > 1:
+                _,evicted = self.entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+def get_result_cache(model_dict):
+    """
+    Get the result cache for a model. Cached results are only valid for the model that produced them.
+    param model_dict: Application data model.
+    return: A ResultCache
+    """
+    if not 'result_cache' in model_dict:
+        model_dict['result_cache'] = ResultCache()
+    return model_dict['result_cache']
+
+def print_threshold_counts(counts,selected=None,width=50):
+    """
+    Print the number of results at each threshold as a text bar chart.
+    param counts: Dictionary with thresholds as keys and result counts as values.
+    param selected: Currently selected threshold which is marked in the chart.
+    param width: Width of the longest bar in characters.
+    """
+    largest = max(max(counts.values()),1)
+    for threshold,count in counts.items():
+        marker = '>' if selected is not None and round(selected,2) == round(threshold,2) else ' '
+        bar = '█' * int(round(width * count / largest))
+        print(f'{marker} {threshold:.2f} {count:8d} {bar}')
@@ -5,7 +5,12 @@ __author__      = 'Roy Gardner, Matt Martin'
 __copyright__   = 'Copyright 2025, Roy Gardner, Sally Gardner, Matt Martin'
 
 from packages import *
-from utilities import encode_text
+from utilities import encode_text,get_segment_indices,get_segment_ids
+from query_cache import cached_encoder
+from similarity import get_similarity_engine
+from ann_index import range_search
+from result_cache import MIN_THRESHOLD,MIN_CLUSTER_THRESHOLD,ThresholdResult,EdgeResult,get_result_cache
+from session_log import SessionLog,checkpoint_clusters,load_resource_dict
 
 ## UTILITY *****************************************************************************************
 
@@ -24,32 +29,152 @@ def get_segments(segment_ids,model_dict):
 
 ## GENERATION *****************************************************************************************
 
-def run_sat_generation(choice_dict,model_dict,encoder):
+def get_generation_result(formulation,model_dict,encoder):
+    """
+    Get the threshold-indexed search result for a formulation from the result cache, running the search if needed.
+    param formulation: Topic formulation text.
+    param model_dict: Application data model.
+    param encoder: Model used to generate encoding of the search formulation.
+    return: A ThresholdResult
+    """
+    cache = get_result_cache(model_dict)
+    key = ('generation',formulation)
+    result = cache.get(key)
+    if result is None:
+        engine = get_similarity_engine(model_dict)
+        vectors = engine.normalise(encode_text([formulation], cached_encoder(encoder)))
+        if model_dict.get('ann_index') is not None:
+            # Only the index lists that can hold a segment at the lowest slider threshold are scored
+            result = ThresholdResult.from_hits(*model_dict['ann_index'].max_cosine_hits(vectors,MIN_THRESHOLD))
+        else:
+            result = ThresholdResult(engine.max_cosine(vectors,min_threshold=MIN_THRESHOLD))
+        cache.put(key,result)
+    return result
+
+def run_sat_generation(choice_dict,model_dict,encoder,use_cache=True):
     """
     Generate the seed SAT from a topic formulation search
     param choice_dict: Contains topic key, formulation text, and search and cluster thresholds from the interface.
     param model_dict: Application data model.
     param encoder: Model used to generate encoding of the search formulation.
+    param use_cache: If True results are served from the result cache so that changing the threshold is instant.
     return: A set of segment IDs
     """
     search_threshold = choice_dict['search_threshold']
 
     pat = choice_dict['formulation']
 
-    # Run the search
-    encodings = encode_text([pat], encoder)
-    encoding = [np.array(encodings).tolist()[0]]
-
-    sim_list = cdist(encoding, model_dict['segment_encodings'],\
-                     lambda v,w: 1 - (np.arccos(1 - cosine(v,w))/np.pi))  
+    if use_cache and search_threshold >= MIN_THRESHOLD:
+        found_segment_indices = get_generation_result(pat,model_dict,encoder).at(search_threshold)
+    else:
+        # Run the search
+        encodings = encode_text([pat], cached_encoder(encoder))
+        vectors = get_similarity_engine(model_dict).normalise(encodings)
+        found_segment_indices = range_search(vectors,search_threshold,model_dict)
 
-    sim_list = list(sim_list.flatten())
-    results = [model_dict['encoded_segments'][i] for i,v in enumerate(sim_list) if v >= search_threshold]
+    results = get_segment_ids(found_segment_indices,model_dict)
     return set(results)
 
+def sat_generation_counts(formulation,model_dict,encoder,thresholds=None):
+    """
+    Count search results at each threshold so that a threshold can be chosen before running the search.
+    param formulation: Topic formulation text.
+    param model_dict: Application data model.
+    param encoder: Model used to generate encoding of the search formulation.
+    param thresholds: List of thresholds. Defaults to the slider thresholds.
+    return: A dictionary with thresholds as keys and result counts as values
+    """
+    return get_generation_result(formulation,model_dict,encoder).counts(thresholds)
+
+def get_generation_results(formulations,model_dict,encoder,min_threshold=MIN_THRESHOLD,use_cache=True):
+    """
+    Get threshold-indexed search results for several formulations. Formulations that are not in the result cache are
+    encoded in one encoder call and scored against the corpus in one blocked pass, or looked up in the model's ANN
+    index if it has one.
+    param formulations: List of topic formulation texts.
+    param model_dict: Application data model.
+    param encoder: Model used to generate encoding of the search formulations.
+    param min_threshold: Lowest threshold the results can answer. Results are only cached at MIN_THRESHOLD.
+    param use_cache: If True results are served from, and added to, the result cache.
+    return: A dictionary with formulations as keys and ThresholdResult values
+    """
+    cache = get_result_cache(model_dict)
+    use_cache = use_cache and min_threshold == MIN_THRESHOLD
+    results = {}
+    for formulation in formulations:
+        result = cache.get(('generation',formulation)) if use_cache else None
+        if result is not None:
+            results[formulation] = result
+    pending = [formulation for formulation in dict.fromkeys(formulations) if not formulation in results]
+    if len(pending) > 0:
+        engine = get_similarity_engine(model_dict)
+        vectors = engine.normalise(encode_text(pending,cached_encoder(encoder)))
+        if model_dict.get('ann_index') is not None:
+            index = model_dict['ann_index']
+            hits = [index.max_cosine_hits(vectors[i:i + 1],min_threshold) for i in range(len(vectors))]
+        else:
+            hits = engine.range_cosines(vectors,min_threshold)
+        for formulation,(indices,cosines) in zip(pending,hits):
+            result = ThresholdResult.from_hits(indices,cosines,min_threshold=min_threshold)
+            if use_cache:
+                cache.put(('generation',formulation),result)
+            results[formulation] = result
+    return results
+
+def run_sat_generation_batch(formulations,model_dict,encoder,search_threshold,use_cache=True):
+    """
+    Run the generation search for several formulations at once, e.g., to compare phrasings of a topic or to search
+    many topics. Costs about the same as a single search, see get_generation_results().
+    param formulations: List of topic formulation texts.
+    param model_dict: Application data model.
+    param encoder: Model used to generate encoding of the search formulations.
+    param search_threshold: Search threshold applied to every formulation.
+    param use_cache: If True results are served from the result cache.
+    return: A dictionary containing 'results', a dictionary with formulations as keys and sets of segment IDs as
+    values, and 'union' and 'intersection', the sets of segment IDs found by any and by every formulation
+    """
+    min_threshold = MIN_THRESHOLD if search_threshold >= MIN_THRESHOLD else search_threshold
+    threshold_results = get_generation_results(formulations,model_dict,encoder,min_threshold=min_threshold,\
+                                               use_cache=use_cache)
+    results = {}
+    for formulation in formulations:
+        found_segment_indices = threshold_results[formulation].at(search_threshold)
+        results[formulation] = set(get_segment_ids(found_segment_indices,model_dict))
+    sets = list(results.values())
+    return {
+        'results': results,
+        'union': set().union(*sets),
+        'intersection': set.intersection(*sets) if len(sets) > 0 else set()
+    }
+
 ## EXPANSION *****************************************************************************************
 
-def run_sat_expansion(map_segment_ids,sat_segment_ids,rejected_segment_ids,model_dict,threshold=0.72):
+def get_expansion_result(map_segment_ids,model_dict):
+    """
+    Get the threshold-indexed mapping result for a set of map segments from the result cache, building it if needed.
+    param map_segment_ids: set of segments in the mapping matrix rows.
+    param model_dict: Application data model.
+    return: A ThresholdResult
+    """
+    cache = get_result_cache(model_dict)
+    key = ('expansion',frozenset(map_segment_ids))
+    result = cache.get(key)
+    if result is None:
+        map_segment_indices = get_segment_indices(map_segment_ids,model_dict)
+        graph = model_dict.get('neighbour_graph')
+        engine = get_similarity_engine(model_dict)
+        if graph is not None and graph.covers(MIN_THRESHOLD):
+            result = ThresholdResult(graph.max_cosine(map_segment_indices))
+        elif model_dict.get('ann_index') is not None:
+            vectors = engine.rows(map_segment_indices)
+            result = ThresholdResult.from_hits(*model_dict['ann_index'].max_cosine_hits(vectors,MIN_THRESHOLD))
+        else:
+            vectors = engine.rows(map_segment_indices)
+            result = ThresholdResult(engine.max_cosine(vectors,min_threshold=MIN_THRESHOLD))
+        cache.put(key,result)
+    return result
+
+def run_sat_expansion(map_segment_ids,sat_segment_ids,rejected_segment_ids,model_dict,threshold=0.72,use_cache=True):
     """
     Semantic mapping is used to find corpus segments similar to a set of SAT segments.
     The mapping matrix has SAT segments in rows and corpus segments in columns.
@@ -68,19 +193,23 @@ def run_sat_expansion(map_segment_ids,sat_segment_ids,rejected_segment_ids,model
     param rejected_segment_ids: current rejected segments
     param model_dict: data model containing segment data and encodings
     param threshold: mapping matrix threshold. Default to 0.72.
+    param use_cache: If True results are served from the result cache so that changing the threshold is instant.
     return A set of corpus segments that are above threshold with respect to the map segments (in matrix row)
     but which are neither members of the current SAT segments set nor members of the current rejected segments set.
     """
 
-    map_segment_indices = [model_dict['encoded_segments'].index(segment_id) for segment_id in map_segment_ids]
-    map_segment_encodings = [model_dict['segment_encodings'][index] for index in map_segment_indices]
-
-    sim_matrix = cdist(map_segment_encodings,model_dict['segment_encodings'],ad.angular_distance)
-
-    t_matrix = (sim_matrix >= threshold).astype(np.int8)
-    ab_indices = np.argwhere(t_matrix == 1).tolist()
-    found_segment_indices = list(set([indices[1] for indices in ab_indices]))
-    found_segment_ids = [model_dict['encoded_segments'][index] for index in found_segment_indices]
+    if use_cache and threshold >= MIN_THRESHOLD:
+        found_segment_indices = get_expansion_result(map_segment_ids,model_dict).at(threshold)
+    else:
+        map_segment_indices = get_segment_indices(map_segment_ids,model_dict)
+        graph = model_dict.get('neighbour_graph')
+        if graph is not None and graph.covers(threshold):
+            # Precomputed neighbours make expansion a lookup and filter
+            found_segment_indices = graph.hits(map_segment_indices,threshold)
+        else:
+            engine = get_similarity_engine(model_dict)
+            found_segment_indices = range_search(engine.rows(map_segment_indices),threshold,model_dict)
+    found_segment_ids = get_segment_ids(found_segment_indices,model_dict)
 
     # The difference between the found and the SAT segment IDs, i.e., remove the accepted
     # segments (the seed set) from the found set.
@@ -90,34 +219,71 @@ def run_sat_expansion(map_segment_ids,sat_segment_ids,rejected_segment_ids,model
     # rejected. Provides candidate segments for the next iteration,
     B = set(A).difference(set(rejected_segment_ids))    
     return B
+
+def sat_expansion_counts(map_segment_ids,sat_segment_ids,rejected_segment_ids,model_dict,thresholds=None):
+    """
+    Count expansion candidates at each threshold so that a mapping threshold can be chosen before running expansion.
+    param map_segment_ids: set of segments in the mapping matrix rows.
+    param sat_segment_ids: set of current SAT segments.
+    param rejected_segment_ids: current rejected segments.
+    param model_dict: Application data model.
+    param thresholds: List of thresholds. Defaults to the slider thresholds.
+    return: A dictionary with thresholds as keys and candidate counts as values
+    """
+    exclude_indices = get_segment_indices(set(sat_segment_ids).union(rejected_segment_ids),model_dict)
+    return get_expansion_result(map_segment_ids,model_dict).counts(thresholds,exclude_indices=exclude_indices)
    
-def cluster_sat_candidates(segment_ids,model_dict,threshold=0.74):
+def get_edge_result(segment_ids,model_dict):
+    """
+    Get the pairwise similarities of a segment set from the result cache, computing them if needed.
+    The cache is keyed by the set's members so any change to the set is a cache miss.
+    param segment_ids: set of segments to be clustered.
+    param model_dict: Application data model.
+    return: An EdgeResult
+    """
+    cache = get_result_cache(model_dict)
+    key = ('clusters',frozenset(segment_ids))
+    result = cache.get(key)
+    if result is None:
+        segment_ids = list(segment_ids)
+        segment_indices = get_segment_indices(segment_ids,model_dict)
+        rows,cols,cosines = get_similarity_engine(model_dict).edges(segment_indices,MIN_CLUSTER_THRESHOLD)
+        result = EdgeResult(segment_ids,rows,cols,cosines)
+        cache.put(key,result)
+    return result
+
+def cluster_sat_candidates(segment_ids,model_dict,threshold=0.74,use_cache=True):
     """
     Cluster SAT candidates
     param segment_ids: set of segments found by topic search at generation or SAT search during expansion. Converted to list.
     param model_dict: Application data model.
     param threshold: User-defined cluster threshold defaulting to 0.74.
+    param use_cache: If True pairwise similarities are cached so re-clustering at another threshold is fast.
     return: A clusters dictionary
     """
-    segment_ids = list(segment_ids)
-    segment_indices = [model_dict['encoded_segments'].index(sid) for sid in segment_ids]
-    segment_encodings = [model_dict['segment_encodings'][i] for i in segment_indices]
-    n = len(segment_encodings)
-    matrix = np.zeros((n, n))
-    row,col = np.triu_indices(n,1)
-    matrix[row,col] = pdist(segment_encodings,ad.angular_distance)
-        
-    t_matrix = (matrix >= threshold).astype(np.int8)
-    
-    graph = csr_matrix(t_matrix)
+    if use_cache and threshold >= MIN_CLUSTER_THRESHOLD:
+        edge_result = get_edge_result(segment_ids,model_dict)
+        segment_ids = edge_result.segment_ids
+        rows,cols = edge_result.at(threshold)
+    else:
+        segment_ids = list(segment_ids)
+        segment_indices = get_segment_indices(segment_ids,model_dict)
+        # Only above-threshold pairs are computed and stored so memory grows with the number of edges, not n^2
+        rows,cols,_ = get_similarity_engine(model_dict).edges(segment_indices,threshold)
+    n = len(segment_ids)
+
+    graph = csr_matrix((np.ones(len(rows),dtype=np.int8),(rows,cols)),shape=(n,n))
     _,labels = connected_components(csgraph=graph,directed=False,return_labels=True)
+    # Each pair is held once in the upper triangle and a segment's degree counts its pairs with later segments
+    degrees = np.bincount(rows,minlength=n)
+
     # Collect the components and concatenate the singletons into one cluster
     component_dict = {}
     for i,label in enumerate(labels):
         if label in component_dict:
-            component_dict[label].append((segment_ids[i],len(graph[i].indices)))
+            component_dict[label].append((segment_ids[i],int(degrees[i])))
         else:
-            component_dict[label] = [(segment_ids[i],len(graph[i].indices))]
+            component_dict[label] = [(segment_ids[i],int(degrees[i]))]
     cluster_dict = {label:component for label,component in component_dict.items() if len(component)>1}
     for label,component in component_dict.items():
         if len(component) == 1:
@@ -128,31 +294,22 @@ def cluster_sat_candidates(segment_ids,model_dict,threshold=0.74):
 
 ## ACCEPTANCE *****************************************************************************************
 
-def accept_review(topic_label,topic_desc,sat_segment_ids,review_sat_ids,resource_dict,model_dict):
+def accept_review(topic_label,topic_desc,sat_segment_ids,review_sat_ids,session_log,model_dict,\
+                  output_path='./outputs/',verbose=True):
     """
-    Called at end of process after review. Users enters a topic label and description which are written
-    to the resources JSON.
+    Called at end of process after review. Users enters a topic label and description which are recorded
+    in the session log with the final SAT.
     param topic_label: Topic label.
     param topic_desc: Topic description.
     param sat_segment_ids: set of accepted post-review SAT segments which may be smaller than the pre-review set.
     param review_sat_ids: set of pre-review SAT segments.
-    param resource_dict: Dictionary storing the process data.
+    param session_log: SessionLog of the process.
     param model_dict: Application data model.    
+    param output_path: Folder the CSV is written to.
+    param verbose: Print the names of the files written if True.
+    return: The name of the CSV file
     """
     
-    resource_dict['topic_label'] = topic_label
-    resource_dict['topic_description'] = topic_desc
-    
-    removed_segment_ids = set()
-    # Check whether any segments have been deselected
-    if len(sat_segment_ids) != len(review_sat_ids):
-        # Find the segments that have been removed
-        removed_segment_ids = review_sat_ids.difference(sat_segment_ids)
-
-    # Updated rg 07/05/2025 to save segment text as well as segment IDs
-    resource_dict['review']['sat_segments_final'] = get_segments(sat_segment_ids,model_dict)
-    resource_dict['review']['removed_segments'] = get_segments(removed_segment_ids,model_dict)
-
     # Generate the CSV
     csv_row_list = []
 
@@ -174,33 +331,126 @@ def accept_review(topic_label,topic_desc,sat_segment_ids,review_sat_ids,resource
         csv_row.append(doc_name)
         csv_row_list.append(csv_row)
 
-    file_name = './outputs/' + resource_dict['topic_key'] + '_final_SAT.csv'
+    file_name = output_path + session_log.topic_key + '_final_SAT.csv'
     with open(file_name, 'w') as f:
         writer = csv.writer(f)
         writer.writerows(csv_row_list)
     f.close()
 
-    print('Final SAT written to file:',file_name)
-        
-    resource_dict['review']['csv_file'] = file_name
-    
-    resource_filename = './outputs/' + resource_dict['topic_key'] + '_resource.json'
-    with open(resource_filename, 'w') as outfile:
-        json.dump(resource_dict, outfile)
-        outfile.close() 
-    
-    resource_dict['end_datetime'] = int(time.time())
-    print('SAT process resources written to file:',resource_filename)
+    if verbose:
+        print('Final SAT written to file:',file_name)
+
+    # Segments unchecked in review are recorded as removed from the SAT set
+    session_log.review(topic_label,topic_desc,sat_segment_ids,file_name)
+    if verbose:
+        print('SAT process resources written to file:',session_log.filename)
+    return file_name
+
+## SESSIONS *****************************************************************************************
+
+def resume_session(topic_key,model_dict,state,output_path='./outputs/'):
+    """
+    Resume a SAT session from its session log, e.g., after a kernel restart. The SAT, rejected, and candidate sets,
+    the checkbox selections, and the clusters last shown are restored from the log and the clusters are listed again
+    without repeating the similarity computations that produced them. If the session stopped while the candidates of
+    an expansion iteration were being found, that search is run again.
+    param topic_key: Topic key of the session.
+    param model_dict: Application data model.
+    param state: CheckboxState of the checkbox server. Its selections are restored and journaled to the log.
+    param output_path: Folder of the session log.
+    return: A dictionary of the notebook variables of the session
+    """
+    session_log = SessionLog(topic_key,output_path,resume=True)
+    log_state = session_log.state
+    checkpoint = log_state['checkpoint']
+    values = checkpoint['values'] if checkpoint is not None else {}
+    # The last seed or iteration is pending if no checkpoint was written after it
+    pending = None
+    for event in log_state['events']:
+        if event['event'] in ['seed','iteration']:
+            pending = event
+        elif event['event'] == 'checkpoint':
+            pending = None
+
+    session = {
+        'session_log': session_log,
+        'topic_key': topic_key,
+        'choice_dict': {'topic_key':topic_key,'formulation':log_state['formulation'],\
+                        'search_threshold':log_state['search_threshold'],\
+                        'cluster_threshold':log_state['cluster_threshold']},
+        'sat_segment_ids': set(log_state['sat_ids']),
+        'rejected_segment_ids': set(log_state['rejected_ids']),
+        'sat_candidate_ids': set(),
+        'first_time': True,
+        'review': False,
+        'review_sat_ids': set(),
+        'cluster_dict': {}
+    }
+    stage = checkpoint['stage'] if checkpoint is not None else 'generation'
+    if pending is None and checkpoint is not None:
+        session['cluster_dict'] = checkpoint_clusters(checkpoint)
+        candidate_ids = set([segment_id for cluster in session['cluster_dict'].values() for segment_id,_ in cluster])
+        if stage == 'generation':
+            session['segment_ids'] = candidate_ids
+        elif stage == 'expansion':
+            session['sat_candidate_ids'] = candidate_ids
+        session['first_time'] = values.get('first_time',True)
+        session['review'] = values.get('review',False)
+        session['review_sat_ids'] = set(values.get('review_sat_ids',[]))
+        selected_ids = set(log_state['selected_ids'])
+    else:
+        selected_ids = set()
+        if pending is not None:
+            # The step after the last checkpoint did not complete so the session continues with expansion
+            stage = 'expansion'
+            values = {}
+            if pending['event'] == 'iteration':
+                values = {'mapping_threshold':pending['mapping_threshold'],\
+                          'cluster_threshold':pending['cluster_threshold']}
+            if pending['event'] == 'iteration' and len(pending['accepted']) > 0:
+                # Find the candidates of the interrupted iteration
+                session['sat_candidate_ids'] = run_sat_expansion(set(pending['accepted']),\
+                                                                 session['sat_segment_ids'],\
+                                                                 session['rejected_segment_ids'],model_dict,\
+                                                                 threshold=values['mapping_threshold'])
+                if len(session['sat_candidate_ids']) > 0:
+                    session['first_time'] = False
+                    session['cluster_dict'] = cluster_sat_candidates(session['sat_candidate_ids'],model_dict,\
+                                                                     threshold=values['cluster_threshold'])
+            session_log.checkpoint('expansion',session['cluster_dict'],selected_ids,\
+                                   first_time=session['first_time'],review=False,**values)
+    if 'mapping_threshold' in values:
+        session['expansion_choice_dict'] = {'mapping_threshold':values['mapping_threshold'],\
+                                            'cluster_threshold':values['cluster_threshold']}
+    if stage == 'review':
+        session['review_choice_dict'] = {'cluster_threshold':values['cluster_threshold']}
+
+    state.selected_ids = selected_ids
+    state.journal = session_log.check
+
+    print('Resumed session:',topic_key)
+    print('Stage:',stage)
+    print('Number of SAT segments:',len(session['sat_segment_ids']))
+    print('Number of rejected segments:',len(session['rejected_segment_ids']))
+    print('Number of selected segments:',len(selected_ids))
+    if log_state['review'] is not None:
+        print('The review of this session was accepted.')
+    if len(session['cluster_dict']) > 0:
+        print('Number of clusters:',len(session['cluster_dict']))
+        print()
+        list_clusters(session['cluster_dict'],model_dict,selected_ids=selected_ids)
+    return session
 
 ## CLUSTER INTERFACE *****************************************************************************************
 
-def list_clusters(cluster_dict, model_dict, check_all=False, model_path=''):
+def list_clusters(cluster_dict, model_dict, check_all=False, model_path='', selected_ids=None):
     """
     List clusters at various stages of pipeline. Supports deep links into ConstituteProject.org for constitutional segments only
     param cluster_dict: Dictionary of clusters.
     param model_dict: Application data model. 
     param check_all: Set to True for review.
     param model_path: Path to the model data, used to determine if hyperlinks should be enabled
+    param selected_ids: Optional set of segment IDs listed checked, e.g., when a session is resumed.
     """
     # Enable hyperlinks only for constitutional data
     enable_hyperlinks = 'constitution' in model_path.lower()
@@ -273,7 +523,7 @@ def list_clusters(cluster_dict, model_dict, check_all=False, model_path=''):
             html_output += f'<td style="word-wrap:break-word;">{segment_text}</td>'
             
             checkbox_html = f'<input onclick="hit(\'{segment_id}\');" type="checkbox" id="{segment_id}" name="{segment_id}" value="{segment_id}"'
-            if check_all:
+            if check_all or (selected_ids is not None and segment_id in selected_ids):
                 checkbox_html += ' checked="checked">'
             else:
                 checkbox_html += '">'
@@ -13,6 +13,9 @@ def server_is_running(port):
 class CheckboxState:
     def __init__(self):
         self.selected_ids = set()
+        # Optional function called with a segment ID and its new selected state on every change, e.g.
+        # SessionLog.check so that selections survive a kernel restart
+        self.journal = None
 
 class CheckboxHandler(BaseHTTPRequestHandler):
     def __init__(self, state, *args, **kwargs):
@@ -43,4 +46,23 @@ class CheckboxHandler(BaseHTTPRequestHandler):
             self.state.selected_ids.discard(selected_id)
         else:
             self.state.selected_ids.add(selected_id)
+        if self.state.journal is not None:
+            self.state.journal(selected_id, selected_id in self.state.selected_ids)
         self.end_headers()
+
+# The encoder service client (RemoteEncoder, encoder_service_hosts, and ENCODER_SERVICE_PORT) and encoder versions
+# (get_encoder_version) are shared with the processing pipeline. They are loaded from processing/encoder_client.py
+# by path because both folders have a packages module.
+def load_encoder_client():
+    filename = os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','..','processing','encoder_client.py')
+    spec = importlib.util.spec_from_file_location('encoder_client',filename)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+encoder_client = sys.modules.get('encoder_client') or load_encoder_client()
+sys.modules['encoder_client'] = encoder_client
+ENCODER_SERVICE_PORT = encoder_client.ENCODER_SERVICE_PORT
+RemoteEncoder = encoder_client.RemoteEncoder
+encoder_service_hosts = encoder_client.encoder_service_hosts
+get_encoder_version = encoder_client.get_encoder_version
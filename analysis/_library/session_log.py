@@ -0,0 +1,338 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+
+__author__      = 'Roy Gardner'
+__copyright__   = 'Copyright 2025, Roy Gardner and Sally Gardner'
+
+"""
+Append-only log of a SAT session.
+
+The resources dictionary of a SAT run stored the complete accepted, rejected, and SAT sets, with segment text, in
+every expansion iteration, and was rewritten in full at the end of the run. A session log instead appends one JSON
+line per step to outputs/<topic_key>_session.jsonl recording only what changed: the generation choices, the seed
+set, the IDs accepted, newly rejected, and removed in each iteration, and the review outcome. The resources dictionary
+is reconstructed from the log by load_resource_dict().
+
+Each line is an event dictionary with an 'event' key:
+
+session: A new session started. The log holds the last session after this event.
+generation: topic_key, formulation, search_threshold, cluster_threshold, and start_datetime.
+seed: The seed SAT segments. Expansion (re)starts from this set with no rejected segments.
+iteration: accepted, rejected, and removed segment IDs, mapping_threshold, and cluster_threshold. The SAT set is
+the previous SAT set without removed plus accepted, and rejected is added to the rejected set.
+review: topic_label, topic_description, the IDs removed from and added to the SAT set in review, csv_file, and
+end_datetime.
+checkpoint: The clusters shown for selection at a stage, the selected IDs, and the notebook values needed to
+continue from that point. Written whenever a cell shows clusters or ends a step.
+check: A checkbox was checked or unchecked.
+
+Lines are flushed to disk as they are written, so a session can be resumed from its last step after a kernel
+restart or crash (see resume_session() in sat.py).
+"""
+
+from packages import *
+
+SESSION_LOG_SUFFIX = '_session.jsonl'
+
+def session_log_filename(topic_key,output_path='./outputs/'):
+    """
+    param topic_key: Topic key.
+    param output_path: Folder of the SAT outputs.
+    return: Path to the topic's session log
+    """
+    return output_path + topic_key + SESSION_LOG_SUFFIX
+
+def new_session_state():
+    """
+    Create the state of an empty session.
+    return: A session state dictionary
+    """
+    return {
+        'topic_key': '',
+        'formulation': '',
+        'search_threshold': 0.0,
+        'cluster_threshold': 0.0,
+        'start_datetime': None,
+        'end_datetime': None,
+        'seed_ids': set(),
+        'sat_ids': set(),
+        'rejected_ids': set(),
+        'events': [],
+        'review': None,
+        'checkpoint': None,
+        'selected_ids': set()
+    }
+
+def apply_event(state,event):
+    """
+    Update a session state with an event.
+    param state: Session state dictionary.
+    param event: Event dictionary.
+    return: The session state
+    """
+    kind = event['event']
+    if kind == 'session':
+        state = new_session_state()
+        state['topic_key'] = event['topic_key']
+    elif kind == 'generation':
+        for key in ['topic_key','formulation','search_threshold','cluster_threshold','start_datetime']:
+            state[key] = event[key]
+    elif kind == 'seed':
+        state['seed_ids'] = set(event['segments'])
+        state['sat_ids'] = set(event['segments'])
+        state['rejected_ids'] = set()
+    elif kind == 'iteration':
+        state['sat_ids'].difference_update(event['removed'])
+        state['sat_ids'].update(event['accepted'])
+        state['rejected_ids'].update(event['rejected'])
+    elif kind == 'review':
+        state['sat_ids'].difference_update(event['removed'])
+        state['sat_ids'].update(event['added'])
+        state['end_datetime'] = event['end_datetime']
+        state['review'] = event
+    elif kind == 'checkpoint':
+        state['checkpoint'] = event
+        state['selected_ids'] = set(event['selected'])
+    elif kind == 'check':
+        if event['selected']:
+            state['selected_ids'].add(event['id'])
+        else:
+            state['selected_ids'].discard(event['id'])
+    state['events'].append(event)
+    return state
+
+def read_session_log(filename):
+    """
+    Replay the last session in a log. A partly written last line, e.g., after a crash, is ignored.
+    param filename: Path to the session log.
+    return: A session state dictionary
+    """
+    state = new_session_state()
+    with open(filename,'r',encoding='utf-8') as f:
+        for line in f:
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            state = apply_event(state,event)
+    return state
+
+class SessionLog:
+    """
+    Writes the events of a SAT session and keeps the current session state. Every write appends the event's line
+    to the log so the cost of a step is proportional to its changes.
+    """
+    def __init__(self,topic_key,output_path='./outputs/',resume=False):
+        """
+        Start a session. Earlier sessions in the topic's log are kept but are not part of this session.
+        param topic_key: Topic key.
+        param output_path: Folder the log is written to.
+        param resume: If True continue the last session in the log instead of starting a new one.
+        """
+        if not os.path.exists(output_path):
+            os.makedirs(output_path)
+        self.topic_key = topic_key
+        self.output_path = output_path
+        self.filename = session_log_filename(topic_key,output_path)
+        self.state = new_session_state()
+        # The checkbox server thread writes check events while the notebook writes the others
+        self.lock = Lock()
+        if os.path.exists(self.filename) and os.path.getsize(self.filename) > 0:
+            # End a line left partly written by a crash so that it doesn't corrupt the next event
+            with open(self.filename,'rb') as f:
+                f.seek(-1,os.SEEK_END)
+                partial = f.read(1) != b'\n'
+            if partial:
+                with open(self.filename,'a',encoding='utf-8') as f:
+                    f.write('\n')
+        if resume:
+            self.state = read_session_log(self.filename)
+        else:
+            self.append({'event':'session','topic_key':topic_key,'datetime':int(time.time())})
+
+    def append(self,event):
+        """
+        Append an event to the log and apply it to the session state.
+        param event: Event dictionary.
+        """
+        with self.lock:
+            with open(self.filename,'a',encoding='utf-8') as f:
+                f.write(json.dumps(event) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self.state = apply_event(self.state,event)
+
+    def generation(self,formulation,search_threshold,cluster_threshold):
+        """
+        Record the generation choices.
+        param formulation: Topic formulation text.
+        param search_threshold: Search threshold.
+        param cluster_threshold: Cluster threshold.
+        """
+        self.append({'event':'generation','topic_key':self.topic_key,'formulation':formulation,\
+                     'search_threshold':search_threshold,'cluster_threshold':cluster_threshold,\
+                     'start_datetime':int(time.time())})
+
+    def seed(self,segment_ids):
+        """
+        Record the seed SAT set.
+        param segment_ids: Set of segment IDs.
+        """
+        self.append({'event':'seed','segments':sorted(segment_ids)})
+
+    def iteration(self,accepted_ids,rejected_ids,removed_ids,mapping_threshold,cluster_threshold):
+        """
+        Record an expansion iteration.
+        param accepted_ids: Set of segment IDs accepted in the iteration.
+        param rejected_ids: Set of segment IDs rejected in the iteration that were not already rejected.
+        param removed_ids: Set of segment IDs removed from the SAT set, i.e., unchecked in review.
+        param mapping_threshold: Mapping threshold.
+        param cluster_threshold: Cluster threshold.
+        """
+        self.append({'event':'iteration','accepted':sorted(accepted_ids),'rejected':sorted(rejected_ids),\
+                     'removed':sorted(removed_ids),'mapping_threshold':mapping_threshold,\
+                     'cluster_threshold':cluster_threshold})
+
+    def review(self,topic_label,topic_desc,sat_segment_ids,csv_file):
+        """
+        Record the outcome of the review.
+        param topic_label: Topic label.
+        param topic_desc: Topic description.
+        param sat_segment_ids: Set of final SAT segment IDs.
+        param csv_file: Path to the final SAT CSV.
+        """
+        self.append({'event':'review','topic_label':topic_label,'topic_description':topic_desc,\
+                     'removed':sorted(self.state['sat_ids'].difference(sat_segment_ids)),\
+                     'added':sorted(set(sat_segment_ids).difference(self.state['sat_ids'])),\
+                     'csv_file':csv_file,'end_datetime':int(time.time())})
+
+    def checkpoint(self,stage,cluster_dict,selected_ids,check_all=False,**values):
+        """
+        Record the clusters shown for selection and the values needed to continue the session from this point.
+        param stage: 'generation', 'expansion', or 'review'.
+        param cluster_dict: Clusters dictionary from cluster_sat_candidates(). Empty if nothing is shown.
+        param selected_ids: Set of selected segment IDs.
+        param check_all: True if the clusters are listed checked, as in review.
+        param values: JSON serialisable notebook values, e.g., thresholds and flags. Sets are stored as lists.
+        """
+        clusters = [[label if label == 'singletons' else int(label),[[segment_id,int(degree)] \
+                     for segment_id,degree in cluster]] for label,cluster in cluster_dict.items()]
+        values = {key:sorted(value) if isinstance(value,set) else value for key,value in values.items()}
+        self.append({'event':'checkpoint','stage':stage,'clusters':clusters,'selected':sorted(selected_ids),\
+                     'check_all':check_all,'values':values})
+
+    def check(self,segment_id,selected):
+        """
+        Record a checkbox change. Called from the checkbox server, see CheckboxState.
+        param segment_id: Segment ID of the checkbox.
+        param selected: True if the segment is selected after the change.
+        """
+        self.append({'event':'check','id':segment_id,'selected':selected})
+
+def checkpoint_clusters(checkpoint):
+    """
+    Get the clusters dictionary of a checkpoint in the format returned by cluster_sat_candidates().
+    param checkpoint: Checkpoint event dictionary.
+    return: A clusters dictionary
+    """
+    return {label:[(segment_id,degree) for segment_id,degree in cluster] for label,cluster in checkpoint['clusters']}
+
+def build_resource_dict(state,model_dict=None):
+    """
+    Reconstruct the resources dictionary of a session, including the accepted, rejected, and SAT sets of every
+    iteration.
+    param state: Session state dictionary.
+    param model_dict: Application data model used to add segment text. If None segment texts are None.
+    return: A resources dictionary
+    """
+    def segments(segment_ids):
+        if model_dict is None:
+            return [{segment_id:None} for segment_id in sorted(segment_ids)]
+        return [{segment_id:model_dict['segments_dict'][segment_id]['text']} for segment_id in sorted(segment_ids)]
+
+    review = state['review'] if state['review'] is not None else {}
+    resource_dict = {
+        'topic_key': state['topic_key'],
+        'topic_label': review.get('topic_label',''),
+        'topic_description': review.get('topic_description',''),
+        'start_datetime': state['start_datetime'],
+        'end_datetime': state['end_datetime'],
+        'generation': {
+            'formulation': state['formulation'],
+            'search_threshold': state['search_threshold'],
+            'cluster_threshold': state['cluster_threshold'],
+            'seed_segments': segments(state['seed_ids'])
+        },
+        'expansion': {
+            'iterations': []
+        },
+        'review':{
+            'sat_segments_final':[],
+            'removed_segments':[],
+            'csv_file':'',
+        },
+        'xml':{
+            'constitution_count':0,
+            'constitutions_updated':[]
+        }
+    }
+    sat_ids = set()
+    rejected_ids = set()
+    for event in state['events']:
+        if event['event'] == 'seed':
+            sat_ids = set(event['segments'])
+            rejected_ids = set()
+        elif event['event'] == 'iteration':
+            sat_ids.difference_update(event['removed'])
+            sat_ids.update(event['accepted'])
+            rejected_ids.update(event['rejected'])
+            resource_dict['expansion']['iterations'].append({
+                'accepted_set':segments(event['accepted']),
+                'rejected_set':segments(rejected_ids),
+                'sat_set':segments(sat_ids),
+                'mapping_threshold':event['mapping_threshold'],
+                'cluster_threshold':event['cluster_threshold']
+            })
+        elif event['event'] == 'review':
+            sat_ids.difference_update(event['removed'])
+            sat_ids.update(event['added'])
+            resource_dict['review']['sat_segments_final'] = segments(sat_ids)
+            resource_dict['review']['removed_segments'] = segments(event['removed'])
+            resource_dict['review']['csv_file'] = event['csv_file']
+    return resource_dict
+
+def load_resource_dict(topic_key,output_path='./outputs/',model_dict=None):
+    """
+    Load the resources dictionary of a topic from its session log or, for runs that predate session logs, from its
+    <topic_key>_resource.json file.
+    param topic_key: Topic key.
+    param output_path: Folder of the SAT outputs.
+    param model_dict: Application data model used to add segment text to reconstructed dictionaries.
+    return: A resources dictionary
+    """
+    filename = session_log_filename(topic_key,output_path)
+    if os.path.exists(filename):
+        return build_resource_dict(read_session_log(filename),model_dict)
+    with open(output_path + topic_key + '_resource.json','r',encoding='utf-8') as f:
+        resource_dict = json.load(f)
+    # Early resource files stored the formulation as 'pat' and the label and description in the review
+    generation = resource_dict['generation']
+    if 'pat' in generation:
+        generation.setdefault('formulation',generation['pat'])
+    for key in ['topic_label','topic_description']:
+        resource_dict.setdefault(key,resource_dict['review'].get(key,''))
+    return resource_dict
+
+def session_topic_keys(output_path='./outputs/'):
+    """
+    List the topics with a session log or resource file in a folder.
+    param output_path: Folder of the SAT outputs.
+    return: A sorted list of topic keys
+    """
+    _,_,files = next(os.walk(output_path))
+    topic_keys = set()
+    for f in files:
+        for suffix in [SESSION_LOG_SUFFIX,'_resource.json']:
+            if f.endswith(suffix):
+                topic_keys.add(f[:-len(suffix)])
+    return sorted(topic_keys)
@@ -0,0 +1,342 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+
+__author__      = 'Roy Gardner'
+__copyright__   = 'Copyright 2025, Roy Gardner and Sally Gardner'
+
+"""
+Vectorised angular similarity between segment encodings.
+
+Angular similarity is defined as 1 - arccos(cos(v,w))/pi which is the value previously computed pair by pair
+by the angular_distance extension. Here the corpus norms are computed once when the model is loaded so that
+a block of similarities is a single matrix multiply followed by a vectorised arccos. Thresholding does not need
+the arccos at all because angular similarity is monotonic in cosine similarity.
+"""
+
+from packages import *
+
+def cosine_threshold(threshold):
+    """
+    Convert an angular similarity threshold to the equivalent cosine similarity threshold.
+    param threshold: Angular similarity threshold in [0,1].
+    return: Cosine similarity threshold.
+    """
+    return np.cos(np.pi * (1.0 - threshold))
+
+def angular_similarity(cosines):
+    """
+    Convert cosine similarities to angular similarities.
+    param cosines: Array of cosine similarities.
+    return: Array of angular similarities with the same shape.
+    """
+    return 1.0 - np.arccos(np.clip(cosines,-1.0,1.0)) / np.pi
+
+class SimilarityEngine:
+    """
+    Computes angular similarity between query vectors, or corpus rows, and the corpus encodings.
+    The encodings matrix is not copied so a memory-mapped matrix stays memory-mapped.
+    """
+    def __init__(self,encodings,block_size=65536,memory_limit=256 * 1024 * 1024,quantised=None):
+        """
+        param encodings: Matrix of segment encodings with one row per segment.
+        param block_size: Number of rows read at a time when computing the corpus norms.
+        param memory_limit: Peak number of bytes of similarity values held at once by max_cosine() and hits().
+        param quantised: Optional QuantisedEncodings scanned before rescoring at full precision.
+        """
+        self.memory_limit = memory_limit
+        self.quantised = quantised
+        if not isinstance(encodings,np.ndarray):
+            encodings = np.asarray(encodings,dtype=np.float32)
+        self.encodings = encodings
+        if quantised is not None:
+            # Norms are stored with the quantised encodings so the full-precision matrix is not read at load
+            self.inverse_norms = 1.0 / quantised.norms
+            return
+        # Norms are computed in blocks so that a memory-mapped matrix is never copied in full
+        norms = np.empty(len(encodings),dtype=np.float32)
+        for start in range(0,len(encodings),block_size):
+            block = np.asarray(encodings[start:start + block_size],dtype=np.float32)
+            norms[start:start + block_size] = np.sqrt(np.einsum('ij,ij->i',block,block))
+        norms[norms == 0] = 1.0
+        self.inverse_norms = 1.0 / norms
+
+    def __len__(self):
+        return len(self.encodings)
+
+    def normalise(self,vectors):
+        """
+        Normalise query vectors to unit length.
+        param vectors: A vector or matrix of vectors.
+        return: A float32 matrix of unit vectors.
+        """
+        vectors = np.atleast_2d(np.asarray(vectors,dtype=np.float32))
+        norms = np.linalg.norm(vectors,axis=1,keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    def rows(self,indices):
+        """
+        Get normalised corpus rows.
+        param indices: Row indices into the encodings matrix.
+        return: A float32 matrix of unit vectors.
+        """
+        indices = np.asarray(indices,dtype=np.int64)
+        return np.asarray(self.encodings[indices],dtype=np.float32) * self.inverse_norms[indices][:,None]
+
+    def cosine(self,vectors):
+        """
+        Cosine similarity of unit vectors against the whole corpus.
+        param vectors: Matrix of unit vectors, e.g. from normalise() or rows().
+        return: Matrix with a row per vector and a column per corpus segment.
+        """
+        return (vectors @ np.asarray(self.encodings,dtype=np.float32).T) * self.inverse_norms
+
+    def similarity(self,vectors):
+        """
+        Angular similarity of query vectors against the whole corpus.
+        param vectors: A vector or matrix of (not necessarily normalised) query vectors.
+        return: Matrix with a row per query vector and a column per corpus segment.
+        """
+        return angular_similarity(self.cosine(self.normalise(vectors)))
+
+    def tiles(self,row_count,memory_limit=None):
+        """
+        Choose tile sizes so that a tile of similarity values stays within the memory limit.
+        param row_count: Number of query vectors.
+        param memory_limit: Overrides the engine memory limit if not None.
+        return: Tuple of rows per tile and corpus columns per tile
+        """
+        if memory_limit is None:
+            memory_limit = self.memory_limit
+        # A tile holds float32 products and the boolean or max intermediates computed from them
+        cell_bytes = 8
+        rows_per_tile = max(1,min(row_count,1024,memory_limit // (cell_bytes * 1024)))
+        columns_per_tile = max(1,min(len(self),memory_limit // (cell_bytes * rows_per_tile)))
+        return rows_per_tile,columns_per_tile
+
+    def tiled_max(self,vectors,matrix,scales,columns=None,memory_limit=None):
+        """
+        Best scaled dot product of each row of a matrix with any of the vectors. The matrix is streamed in column tiles
+        and the vectors in row tiles so that only the per-row maximum is kept and peak memory does not grow with the
+        number of vectors.
+        param vectors: Matrix of unit vectors.
+        param matrix: Encodings matrix, full precision or quantised.
+        param scales: Positive scale applied to the dot products of each matrix row.
+        param columns: Optional matrix rows to score. Defaults to every row.
+        param memory_limit: Overrides the engine memory limit if not None.
+        return: Vector with an entry per scored matrix row.
+        """
+        column_count = len(matrix) if columns is None else len(columns)
+        max_values = np.full(column_count,-1.0,dtype=np.float32)
+        if len(vectors) == 0:
+            return max_values
+        rows_per_tile,columns_per_tile = self.tiles(len(vectors),memory_limit=memory_limit)
+        for column_start in range(0,column_count,columns_per_tile):
+            column_stop = min(column_start + columns_per_tile,column_count)
+            if columns is None:
+                tile_columns = slice(column_start,column_stop)
+            else:
+                tile_columns = columns[column_start:column_stop]
+            matrix_tile = np.asarray(matrix[tile_columns],dtype=np.float32).T
+            tile_scales = scales[tile_columns]
+            tile_max = max_values[column_start:column_stop]
+            for row_start in range(0,len(vectors),rows_per_tile):
+                products = vectors[row_start:row_start + rows_per_tile] @ matrix_tile
+                np.maximum(tile_max,products.max(axis=0) * tile_scales,out=tile_max)
+        return max_values
+
+    def max_cosine(self,vectors,min_threshold=None,memory_limit=None):
+        """
+        Best cosine similarity of each corpus segment to any of the vectors.
+        If the engine has quantised encodings and min_threshold is given, the quantised matrix is scanned first and
+        only segments that could be at or above min_threshold are rescored at full precision. Every other segment
+        is given a cosine of -1. Results at or above min_threshold are identical to a full-precision scan.
+        param vectors: Matrix of unit vectors.
+        param min_threshold: Optional angular similarity threshold below which exact values are not needed.
+        param memory_limit: Overrides the engine memory limit if not None.
+        return: Vector with an entry per corpus segment.
+        """
+        vectors = np.asarray(vectors,dtype=np.float32)
+        if self.quantised is None or min_threshold is None or len(vectors) == 0:
+            return self.tiled_max(vectors,self.encodings,self.inverse_norms,memory_limit=memory_limit)
+
+        quantised = self.quantised
+        approximate = self.tiled_max(vectors,quantised.matrix,quantised.scales,memory_limit=memory_limit)
+        # A segment's quantisation error bounds how far its approximate cosine with a unit vector can be from the
+        # exact value. The small margin absorbs float32 rounding.
+        survivors = np.flatnonzero(approximate + quantised.errors + 1e-5 >= cosine_threshold(min_threshold))
+        max_cosines = np.full(len(self),-1.0,dtype=np.float32)
+        max_cosines[survivors] = self.tiled_max(vectors,self.encodings,self.inverse_norms,columns=survivors,\
+                                                memory_limit=memory_limit)
+        return max_cosines
+
+    def hits(self,vectors,threshold,memory_limit=None):
+        """
+        Find corpus segments whose angular similarity to at least one vector is at or above threshold.
+        param vectors: Matrix of unit vectors.
+        param threshold: Angular similarity threshold.
+        param memory_limit: Overrides the engine memory limit if not None.
+        return: Sorted array of corpus row indices.
+        """
+        if len(vectors) == 0:
+            return np.array([],dtype=np.int64)
+        max_cosines = self.max_cosine(vectors,min_threshold=threshold,memory_limit=memory_limit)
+        return np.flatnonzero(max_cosines >= cosine_threshold(threshold))
+
+    def range_cosines(self,vectors,min_threshold,memory_limit=None):
+        """
+        Find the corpus segments at or above a threshold for each of several vectors in one blocked pass over the
+        corpus, so that N queries cost one matrix product per tile rather than N scans. With quantised encodings the
+        quantised matrix is scanned and only possible matches are rescored at full precision.
+        param vectors: Matrix of unit vectors.
+        param min_threshold: Angular similarity threshold.
+        param memory_limit: Overrides the engine memory limit if not None.
+        return: List with a tuple of (corpus row indices, cosines) per vector
+        """
+        vectors = np.asarray(vectors,dtype=np.float32)
+        cos_threshold = cosine_threshold(min_threshold)
+        if self.quantised is None:
+            matrix,scales = self.encodings,self.inverse_norms
+        else:
+            matrix,scales = self.quantised.matrix,self.quantised.scales
+        vector_indices = [np.array([],dtype=np.int64)]
+        columns = [np.array([],dtype=np.int64)]
+        cosines = [np.array([],dtype=np.float32)]
+        rows_per_tile,columns_per_tile = self.tiles(len(vectors),memory_limit=memory_limit)
+        for column_start in range(0,len(self),columns_per_tile):
+            column_stop = min(column_start + columns_per_tile,len(self))
+            matrix_tile = np.asarray(matrix[column_start:column_stop],dtype=np.float32).T
+            tile_scales = scales[column_start:column_stop]
+            for row_start in range(0,len(vectors),rows_per_tile):
+                products = (vectors[row_start:row_start + rows_per_tile] @ matrix_tile) * tile_scales
+                if self.quantised is None:
+                    rows,cols = np.nonzero(products >= cos_threshold)
+                else:
+                    # See max_cosine() for the error bound
+                    bounds = products + self.quantised.errors[column_start:column_stop] + 1e-5
+                    rows,cols = np.nonzero(bounds >= cos_threshold)
+                vector_indices.append(rows + row_start)
+                columns.append(cols + column_start)
+                cosines.append(products[rows,cols])
+        vector_indices = np.concatenate(vector_indices)
+        columns = np.concatenate(columns)
+        cosines = np.concatenate(cosines)
+
+        if self.quantised is not None and len(columns) > 0:
+            # Rescore the possible matches at full precision
+            survivors,positions = np.unique(columns,return_inverse=True)
+            exact = np.empty(len(columns),dtype=np.float32)
+            for start in range(0,len(survivors),columns_per_tile):
+                stop = min(start + columns_per_tile,len(survivors))
+                products = vectors @ self.rows(survivors[start:stop]).T
+                in_tile = (positions >= start) & (positions < stop)
+                exact[in_tile] = products[vector_indices[in_tile],positions[in_tile] - start]
+            above = exact >= cos_threshold
+            vector_indices,columns,cosines = vector_indices[above],columns[above],exact[above]
+
+        order = np.argsort(vector_indices,kind='stable')
+        splits = np.searchsorted(vector_indices[order],np.arange(1,len(vectors)))
+        return [(c,v) for c,v in zip(np.split(columns[order],splits),np.split(cosines[order],splits))]
+
+    def pairwise(self,indices):
+        """
+        Angular similarities between corpus rows, equivalent to pdist() with the angular distance metric.
+        param indices: Row indices into the encodings matrix.
+        return: Condensed similarity vector in pdist() order.
+        """
+        vectors = self.rows(indices)
+        row,col = np.triu_indices(len(vectors),1)
+        return angular_similarity((vectors @ vectors.T)[row,col])
+
+    def edges(self,indices,threshold,memory_limit=None):
+        """
+        Find pairs of corpus rows whose angular similarity is at or above threshold. Rows are scored in blocks against
+        the rows that follow them so only one block of similarities is held and only above-threshold pairs are kept.
+        param indices: Row indices into the encodings matrix.
+        param threshold: Angular similarity threshold.
+        param memory_limit: Overrides the engine memory limit if not None.
+        return: Tuple of arrays (i,j,cosine) with i < j, where i and j are positions in indices
+        """
+        vectors = self.rows(indices)
+        n = len(vectors)
+        if memory_limit is None:
+            memory_limit = self.memory_limit
+        rows_per_block = max(1,min(n,memory_limit // (8 * max(n,1))))
+        cos_threshold = cosine_threshold(threshold)
+        edge_rows = [np.array([],dtype=np.int64)]
+        edge_cols = [np.array([],dtype=np.int64)]
+        edge_cosines = [np.array([],dtype=np.float32)]
+        for start in range(0,n,rows_per_block):
+            stop = min(start + rows_per_block,n)
+            cosines = vectors[start:stop] @ vectors[start:].T
+            rows,cols = np.nonzero(cosines >= cos_threshold)
+            # Keep the upper triangle only, i.e., each pair once and no self pairs
+            upper = cols > rows
+            rows,cols = rows[upper],cols[upper]
+            edge_rows.append(rows + start)
+            edge_cols.append(cols + start)
+            edge_cosines.append(cosines[rows,cols])
+        return np.concatenate(edge_rows),np.concatenate(edge_cols),np.concatenate(edge_cosines)
+
+class QuantisedEncodings:
+    """
+    Reduced-precision copy of the unit-normalised segment encodings written by the processing pipeline
+    (see quantise_encodings() in processing/utilities.py). Row i approximates the unit encoding of segment i as
+    matrix[i] * scales[i] and errors[i] is the length of the difference, which bounds the error of its cosine with any
+    unit vector.
+    """
+    def __init__(self,matrix,parameters):
+        """
+        param matrix: float16 or int8 matrix with a row per segment.
+        param parameters: float32 matrix with columns scale, error, and norm of the full-precision encoding.
+        """
+        self.matrix = matrix
+        self.scales = np.ascontiguousarray(parameters[:,0])
+        self.errors = np.ascontiguousarray(parameters[:,1])
+        self.norms = np.ascontiguousarray(parameters[:,2])
+
+    def __len__(self):
+        return len(self.matrix)
+
+def load_quantised_encodings(model_path,encodings,sample_size=64):
+    """
+    Memory-map the model's quantised encodings if the processing pipeline built them and they match the encodings.
+    Files left by an earlier build of the model are ignored with a warning. They are detected by their shape or by the
+    full-precision norms recorded for a sample of rows.
+    param model_path: Path to the model files.
+    param encodings: The model's segment encodings.
+    param sample_size: Number of rows whose recorded norms are checked.
+    return: A QuantisedEncodings or None
+    """
+    matrix_filename = model_path + 'segment_encodings_q.npy'
+    parameters_filename = model_path + 'segment_encodings_q_parameters.npy'
+    if not os.path.exists(matrix_filename):
+        return None
+    if not os.path.exists(parameters_filename):
+        print('Warning: segment_encodings_q_parameters.npy is missing so the quantised encodings are ignored.')
+        return None
+    matrix = np.load(matrix_filename,mmap_mode='r')
+    parameters = np.load(parameters_filename)
+    if matrix.shape != encodings.shape or parameters.shape != (len(encodings),3):
+        print(f'Warning: the quantised encodings ({matrix.shape[0]} rows) do not match the segment encodings '\
+              f'({len(encodings)} rows) and are ignored. Please reprocess the model.')
+        return None
+    sample = np.unique(np.linspace(0,len(encodings) - 1,min(sample_size,len(encodings))).astype(np.int64))
+    block = np.asarray(encodings[sample],dtype=np.float32)
+    norms = np.sqrt(np.einsum('ij,ij->i',block,block))
+    norms[norms == 0] = 1.0
+    if not np.allclose(norms,parameters[sample,2],rtol=1e-5,atol=1e-6):
+        print('Warning: the quantised encodings were built from different segment encodings and are ignored. '\
+              'Please reprocess the model.')
+        return None
+    return QuantisedEncodings(matrix,parameters)
+
+def get_similarity_engine(model_dict):
+    """
+    Get the similarity engine for a model, creating it if the model was not loaded with do_load.
+    param model_dict: Application data model.
+    return: A SimilarityEngine
+    """
+    if not 'similarity_engine' in model_dict:
+        model_dict['similarity_engine'] = SimilarityEngine(model_dict['segment_encodings'])
+    return model_dict['similarity_engine']
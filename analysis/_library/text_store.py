@@ -0,0 +1,104 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+
+__author__      = 'Roy Gardner'
+__copyright__   = 'Copyright 2025, Roy Gardner and Sally Gardner'
+
+"""
+Memory-mapped segment text.
+
+The processing pipeline writes segment text as a single UTF-8 blob (segment_texts.bin) and an array of byte offsets
+(segment_text_offsets.npy) in encodings row order (see write_text_store() in processing/utilities.py). Text is only
+needed for the few segments that are displayed or exported, so the store reads a segment's bytes on demand rather
+than holding every segment in a dictionary. SegmentTextStore supports the model_dict['segments_dict'][segment_id]['text']
+interface of segments_dict.json.
+"""
+
+from packages import *
+
+class SegmentTextStore(Mapping):
+    """
+    Read-only mapping from segment ID to a dictionary containing the segment text.
+    """
+    def __init__(self,blob,offsets,segment_index):
+        """
+        param blob: UTF-8 bytes of every segment text in encodings row order.
+        param offsets: Byte offsets with the text of row i at blob[offsets[i]:offsets[i+1]].
+        param segment_index: Dictionary mapping segment IDs to encodings rows.
+        """
+        self.blob = blob
+        self.offsets = offsets
+        self.segment_index = segment_index
+
+    @classmethod
+    def load(cls,model_path,segment_index):
+        """
+        Memory-map a text store written by the processing pipeline.
+        param model_path: Path to the model files.
+        param segment_index: Dictionary mapping segment IDs to encodings rows.
+        return: A SegmentTextStore
+        """
+        filename = model_path + 'segment_texts.bin'
+        # A zero-length file cannot be memory-mapped
+        if os.path.getsize(filename) > 0:
+            blob = np.memmap(filename,dtype=np.uint8,mode='r')
+        else:
+            blob = np.zeros(0,dtype=np.uint8)
+        offsets = np.load(model_path + 'segment_text_offsets.npy',mmap_mode='r')
+        if len(offsets) != len(segment_index) + 1:
+            raise ValueError('Segment text store and encoded segments differ in length. Please reprocess the model.')
+        return cls(blob,offsets,segment_index)
+
+    def text(self,row):
+        """
+        Get the text of a segment by encodings row.
+        param row: Encodings row.
+        return: Segment text
+        """
+        return self.blob[self.offsets[row]:self.offsets[row + 1]].tobytes().decode('utf-8')
+
+    def __getitem__(self,segment_id):
+        return {'text':self.text(self.segment_index[segment_id])}
+
+    def __contains__(self,segment_id):
+        return segment_id in self.segment_index
+
+    def __iter__(self):
+        return iter(self.segment_index)
+
+    def __len__(self):
+        return len(self.segment_index)
+
+def has_text_store(model_path):
+    """
+    Check whether a model has a segment text store.
+    param model_path: Path to the model files.
+    return: True if the text store files exist
+    """
+    return os.path.exists(model_path + 'segment_texts.bin') and \
+        os.path.exists(model_path + 'segment_text_offsets.npy')
+
+def convert_segment_texts(model_path,verbose=True):
+    """
+    Write a text store for a model built before the pipeline wrote one, from segments_dict.json and
+    encoded_segments.json. The JSON files are left in place.
+    param model_path: Path to the model files.
+    param verbose: Print progress if True.
+    """
+    if verbose:
+        print('Converting segment text to a text store…')
+    with open(model_path + 'segments_dict.json','r',encoding='utf-8') as f:
+        segments_dict = json.load(f)
+    with open(model_path + 'encoded_segments.json','r',encoding='utf-8') as f:
+        encoded_segments = json.load(f)
+    offsets = np.zeros(len(encoded_segments) + 1,dtype=np.int64)
+    # Write to temporary files first so that an interrupted conversion never leaves a partial store
+    tmp_filename = model_path + 'segment_texts.tmp.bin'
+    with open(tmp_filename,'wb') as f:
+        for i,segment_id in enumerate(encoded_segments):
+            data = segments_dict[segment_id]['text'].encode('utf-8')
+            f.write(data)
+            offsets[i + 1] = offsets[i] + len(data)
+    np.save(model_path + 'segment_text_offsets.tmp.npy',offsets)
+    os.replace(model_path + 'segment_text_offsets.tmp.npy',model_path + 'segment_text_offsets.npy')
+    os.replace(tmp_filename,model_path + 'segment_texts.bin')
@@ -5,6 +5,12 @@ __author__      = 'Roy Gardner'
 __copyright__   = 'Copyright 2025, Roy and Sally Gardner'
 
 from packages import *
+from similarity import SimilarityEngine,load_quantised_encodings
+from ann_index import load_ann_index
+from neighbour_graph import load_neighbour_graph
+from result_cache import print_threshold_counts
+from text_store import SegmentTextStore,has_text_store,convert_segment_texts
+from server import ENCODER_SERVICE_PORT,RemoteEncoder,encoder_service_hosts
 
 def do_load(model_path,exclusion_list=[],verbose=True):
     # Load the data model
@@ -12,17 +18,97 @@ def do_load(model_path,exclusion_list=[],verbose=True):
         print('Loading model…')
     model_dict = {}
 
+    # Older models hold encodings as JSON so convert them once to the binary format
+    if not os.path.exists(model_path + 'segment_encodings.npy') and \
+        os.path.exists(model_path + 'segment_encodings.json'):
+        convert_encodings(model_path,verbose=verbose)
+    # Likewise segment text is converted once to a memory-mapped text store
+    if not has_text_store(model_path) and os.path.exists(model_path + 'segments_dict.json'):
+        convert_segment_texts(model_path,verbose=verbose)
+
     _, _, files = next(os.walk(model_path))
     files = [f for f in files if f.endswith('.json') and not f in exclusion_list]
+    # Encodings and segment text are memory-mapped and the manifest is only used by the processing pipeline
+    files = [f for f in files if not f in ['segment_encodings.json','segments_dict.json','manifest.json']]
     for file in files:
         model_name = os.path.splitext(file)[0]
         with open(model_path + file, 'r', encoding='utf-8') as f:
             model_dict[model_name] = json.load(f)
             f.close() 
+
+    model_dict['segment_encodings'] = load_encodings(model_path)
+    if len(model_dict['segment_encodings']) != len(model_dict['encoded_segments']):
+        raise ValueError('Segment encodings and encoded segments differ in length. Please reprocess the model.')
+    build_segment_index(model_dict)
+    model_dict['segments_dict'] = SegmentTextStore.load(model_path,model_dict['segment_index'])
+    # Quantised encodings built by the processing pipeline are scanned first and survivors rescored at full precision
+    quantised = load_quantised_encodings(model_path,model_dict['segment_encodings'])
+    model_dict['similarity_engine'] = SimilarityEngine(model_dict['segment_encodings'],quantised=quantised)
+    # Optional ANN index built by the processing pipeline
+    model_dict['ann_index'] = load_ann_index(model_path,model_dict)
+    # Optional precomputed neighbour graph built by the processing pipeline
+    model_dict['neighbour_graph'] = load_neighbour_graph(model_path,model_dict['similarity_engine'])
     if verbose:
         print('Finished loading model.')
     return model_dict
 
+def build_segment_index(model_dict):
+    """
+    Build the segment ID to encodings row map and the row to segment ID array.
+    param model_dict: Application data model containing encoded_segments.
+    """
+    model_dict['segment_index'] = {segment_id:i for i,segment_id in enumerate(model_dict['encoded_segments'])}
+    model_dict['segment_id_array'] = np.array(model_dict['encoded_segments'],dtype=object)
+
+def get_segment_indices(segment_ids,model_dict):
+    """
+    Map segment IDs to rows of the encodings matrix.
+    param segment_ids: An iterable of segment IDs.
+    param model_dict: Application data model.
+    return: An array of row indices in the same order as segment_ids
+    """
+    if not 'segment_index' in model_dict:
+        build_segment_index(model_dict)
+    segment_index = model_dict['segment_index']
+    return np.array([segment_index[segment_id] for segment_id in segment_ids],dtype=np.int64)
+
+def get_segment_ids(segment_indices,model_dict):
+    """
+    Map rows of the encodings matrix to segment IDs.
+    param segment_indices: An array of row indices.
+    param model_dict: Application data model.
+    return: An array of segment IDs in the same order as segment_indices
+    """
+    if not 'segment_id_array' in model_dict:
+        build_segment_index(model_dict)
+    return model_dict['segment_id_array'][np.asarray(segment_indices,dtype=np.int64)]
+
+def load_encodings(model_path):
+    """
+    Memory-map the segment encodings matrix. Row i is the encoding of the segment at position i in encoded_segments.
+    param model_path: Path to the model files.
+    return: A read-only float32 matrix backed by segment_encodings.npy
+    """
+    return np.load(model_path + 'segment_encodings.npy',mmap_mode='r')
+
+def convert_encodings(model_path,verbose=True):
+    """
+    Convert segment_encodings.json to the binary segment_encodings.npy model format.
+    The JSON file is left in place and is ignored by do_load once the conversion has been done.
+    param model_path: Path to the model files.
+    param verbose: Print progress if True.
+    """
+    json_filename = model_path + 'segment_encodings.json'
+    if verbose:
+        print('Converting segment encodings to binary format…')
+    with open(json_filename, 'r', encoding='utf-8') as f:
+        segment_encodings = np.asarray(json.load(f),dtype=np.float32)
+        f.close()
+    # Write to a temporary file first so that an interrupted conversion never leaves a partial matrix
+    tmp_filename = model_path + 'segment_encodings.tmp.npy'
+    np.save(tmp_filename,segment_encodings)
+    os.replace(tmp_filename,model_path + 'segment_encodings.npy')
+
 def popup(text):
     display(Javascript("alert('{}')".format(text)))
 
@@ -33,6 +119,39 @@ def alert(msg):
         display(Javascript("alert('{}')".format(text)))
     popup(msg)
 
+class LazyEncoder:
+    """
+    Encoder that is loaded the first time text is encoded, so that TensorFlow is only imported once a formulation is
+    actually encoded. If the local encoder service (see processing/encoder_service.py) hosts the encoder it is used
+    instead and TensorFlow is not imported at all.
+    """
+    def __init__(self,encoder_path,port=ENCODER_SERVICE_PORT):
+        """
+        param encoder_path: Path to the encoder, e.g. USE v4.
+        param port: Port of the encoder service. 0 always loads the encoder in the kernel.
+        """
+        self.encoder_path = encoder_path
+        self.port = port
+        self.encoder = None
+        self.lock = Lock()
+
+    def load(self):
+        """
+        Load the encoder if it isn't already loaded.
+        return: The encoder
+        """
+        # Batch runs may encode from several threads and the encoder must only be loaded once
+        with self.lock:
+            if self.encoder is None:
+                if self.port > 0 and encoder_service_hosts(self.encoder_path,self.port):
+                    self.encoder = RemoteEncoder(self.encoder_path,self.port)
+                else:
+                    self.encoder = hub.load(self.encoder_path)
+        return self.encoder
+
+    def __call__(self,text_list):
+        return self.load()(text_list)
+
 def encode_text(text_list, encoder):
     """
     Get a list of encoding vectors for the text segments in text_list
@@ -43,7 +162,7 @@ def encode_text(text_list, encoder):
     encodings = encoder(text_list)
     return np.array(encodings).tolist()
 
-def accept_review_interface(sat_segment_ids,review_sat_ids,resource_dict,model_dict,accept_review):
+def accept_review_interface(sat_segment_ids,review_sat_ids,session_log,model_dict,accept_review):
     
     import re
     
@@ -78,7 +197,7 @@ def accept_review_interface(sat_segment_ids,review_sat_ids,resource_dict,model_d
         if sanitised_desc != topic_desc.strip():
             alert_text = 'The topic description was sanitised. Please check the value: ' + sanitised_desc
             popup(alert_text)
-        accept_review(sanitised_label,sanitised_desc,sat_segment_ids,review_sat_ids,resource_dict,model_dict)
+        accept_review(sanitised_label,sanitised_desc,sat_segment_ids,review_sat_ids,session_log,model_dict)
         
     label_text = widgets.Text(
         layout={'width': 'initial'},
@@ -112,7 +231,15 @@ def accept_review_interface(sat_segment_ids,review_sat_ids,resource_dict,model_d
     out = widgets.Output()
     display(out)
 
-def generation_interface(choice_dict,def_search_threshold,def_cluster_threshold):
+def generation_interface(choice_dict,def_search_threshold,def_cluster_threshold,preview=None):
+    """
+    Interface for choosing the topic key, formulation, and search and cluster thresholds.
+    param choice_dict: Dictionary populated with the choices.
+    param def_search_threshold: Default search threshold.
+    param def_cluster_threshold: Default cluster threshold.
+    param preview: Optional function taking a formulation and returning result counts at each search threshold.
+    If supplied, the counts are shown when choices are applied and as the search slider moves.
+    """
 
     import re
 
@@ -159,6 +286,21 @@ def generation_interface(choice_dict,def_search_threshold,def_cluster_threshold)
             popup(alert_text)
         choice_dict['formulation'] = sanitised
 
+        if preview is not None:
+            counts_dict.clear()
+            counts_dict.update(preview(sanitised))
+            show_counts(search_slider.value)
+
+    counts_dict = {}
+
+    def show_counts(threshold):
+        if len(counts_dict) == 0:
+            return
+        count_label.value = f'Results at search threshold {threshold:.2f}: {counts_dict.get(round(threshold,2),0)}'
+        with out:
+            clear_output()
+            print_threshold_counts(counts_dict,selected=threshold)
+
     key_text = widgets.Text(
         layout={'width': 'initial'},
         value='',
@@ -215,6 +357,9 @@ def generation_interface(choice_dict,def_search_threshold,def_cluster_threshold)
     threshold_label = widgets.Label(
         value='THRESHOLDS:',
     )
+    count_label = widgets.Label(
+        value='',
+    )
     
     display(key_text)
     display(threshold_label)
@@ -222,8 +367,10 @@ def generation_interface(choice_dict,def_search_threshold,def_cluster_threshold)
     display(cluster_slider)
     display(formulation_text)
     display(apply_button)
+    display(count_label)
 
     apply_button.on_click(apply)
+    search_slider.observe(lambda change: show_counts(change['new']),names='value')
     out = widgets.Output()
     display(out)
 
@@ -237,12 +384,35 @@ def init_choice_dict():
 
 
 
-def expansion_interface(expansion_choice_dict,def_mapping_threshold,def_cluster_threshold):
+def expansion_interface(expansion_choice_dict,def_mapping_threshold,def_cluster_threshold,preview=None):
+    """
+    Interface for choosing the expansion mapping and cluster thresholds.
+    param expansion_choice_dict: Dictionary populated with the choices.
+    param def_mapping_threshold: Default mapping threshold.
+    param def_cluster_threshold: Default cluster threshold.
+    param preview: Optional function returning candidate counts at each mapping threshold.
+    If supplied, the counts are shown when choices are applied and as the mapping slider moves.
+    """
 
     def apply(change):
         expansion_choice_dict['mapping_threshold'] = mapping_slider.value
         expansion_choice_dict['cluster_threshold'] = cluster_slider.value
 
+        if preview is not None:
+            counts_dict.clear()
+            counts_dict.update(preview())
+            show_counts(mapping_slider.value)
+
+    counts_dict = {}
+
+    def show_counts(threshold):
+        if len(counts_dict) == 0:
+            return
+        count_label.value = f'Candidates at mapping threshold {threshold:.2f}: {counts_dict.get(round(threshold,2),0)}'
+        with out:
+            clear_output()
+            print_threshold_counts(counts_dict,selected=threshold)
+
     mapping_slider = widgets.FloatSlider(
         value=def_mapping_threshold,
         min=0.58,
@@ -281,13 +451,18 @@ def expansion_interface(expansion_choice_dict,def_mapping_threshold,def_cluster_
     threshold_label = widgets.Label(
         value='THRESHOLDS:',
     )
+    count_label = widgets.Label(
+        value='',
+    )
     
     display(threshold_label)
     display(mapping_slider)
     display(cluster_slider)
     display(apply_button)
+    display(count_label)
 
     apply_button.on_click(apply)
+    mapping_slider.observe(lambda change: show_counts(change['new']),names='value')
     out = widgets.Output()
     display(out)
 
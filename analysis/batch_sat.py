@@ -0,0 +1,59 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+
+__author__      = 'Roy Gardner'
+__copyright__   = 'Copyright 2025, Roy Gardner and Sally Gardner'
+
+"""
+Command line interface for headless batch SAT runs (see _library/batch.py). Run from the analysis folder, e.g.:
+
+Score cutoff acceptance for topics in a JSON or CSV file:
+python batch_sat.py --model ../model/ccp/ --topics topics.json --policy cutoff --cutoff 0.75
+
+Replay every topic recorded in ./outputs/ and write the results to ./outputs/batch/:
+python batch_sat.py --model ../model/ccp/ --policy replay --replay_path ./outputs/
+
+Results are written in the notebook's session log and CSV format.
+"""
+
+import os
+import sys
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'_library'))
+
+from packages import *
+from utilities import do_load,LazyEncoder
+from batch import ScoreCutoffPolicy,ReplayPolicy,load_topics,replay_topics,run_sat_batch
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Run the SAT process for many topics against one model.')
+    parser.add_argument('--model', required=True, help='Path to the model folder.')
+    parser.add_argument('--topics', default='', help='JSON or CSV file of topics. Optional when replaying.')
+    parser.add_argument('--policy', choices=['cutoff','replay'], default='cutoff', help='Acceptance policy.')
+    parser.add_argument('--cutoff', type=float, default=0.75, help='Similarity cutoff of the cutoff policy.')
+    parser.add_argument('--seed_cutoff', type=float, default=None, help='Seed cutoff. Defaults to --cutoff.')
+    parser.add_argument('--replay_path', default='./outputs/',
+                        help='Folder of session logs or resource files to replay.')
+    parser.add_argument('--output_path', default='./outputs/batch/', help='Folder results are written to.')
+    parser.add_argument('--workers', type=int, default=4, help='Number of worker threads.')
+    args = parser.parse_args()
+
+    model_path = args.model if args.model.endswith(os.sep) else args.model + os.sep
+    output_path = args.output_path if args.output_path.endswith(os.sep) else args.output_path + os.sep
+    replay_path = args.replay_path if args.replay_path.endswith(os.sep) else args.replay_path + os.sep
+
+    if args.policy == 'replay':
+        policy = ReplayPolicy(resource_path=replay_path)
+        topics = load_topics(args.topics) if len(args.topics) > 0 else replay_topics(replay_path)
+    else:
+        if len(args.topics) == 0:
+            parser.error('--topics is required by the cutoff policy')
+        policy = ScoreCutoffPolicy(cutoff=args.cutoff,seed_cutoff=args.seed_cutoff)
+        topics = load_topics(args.topics)
+
+    model_dict = do_load(model_path,exclusion_list=['config.json'],verbose=True)
+    with open(model_path + 'config.json','r',encoding='utf-8') as f:
+        encoder = LazyEncoder(json.load(f)['encoder_path'])
+
+    run_sat_batch(topics,model_dict,encoder,policy,output_path=output_path,workers=args.workers)
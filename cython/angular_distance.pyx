@@ -1,8 +1,18 @@
 from libc.math cimport sqrt
 from libc.math cimport acos
+from libc.math cimport cos
+from libc.math cimport M_PI
+from cython.parallel cimport prange
+cimport cython
 import numpy as np
 cimport numpy as np
 
+# Encodings may be float32 or float64. Both arguments of a kernel must have the same type. Arguments are const so
+# that read-only arrays, e.g. encodings memory-mapped with np.load(..., mmap_mode='r'), are accepted.
+ctypedef fused floating_t:
+    float
+    double
+
 cdef cosine_cy(np.ndarray[np.float64_t] v, np.ndarray[np.float64_t] w):
     vv: np.float64_t=0.0
     ww: np.float64_t=0.0
@@ -19,3 +29,104 @@ cpdef angular_distance(np.ndarray[np.float64_t] v, np.ndarray[np.float64_t] w):
     Compute inverse of angular distance between to vectors v and w
     """
     return 1 - (acos(1 - cosine_cy(v,w))/np.pi)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline double cosine_similarity(const floating_t[:, ::1] A, Py_ssize_t i, const floating_t[:, ::1] B, Py_ssize_t j,
+                                     double[::1] a_norms, double[::1] b_norms) noexcept nogil:
+    cdef Py_ssize_t k
+    cdef double dot = 0.0
+    cdef double c
+    for k in range(A.shape[1]):
+        dot += A[i,k] * B[j,k]
+    c = dot / (a_norms[i] * b_norms[j])
+    # Rounding can take the cosine of (near) parallel vectors just outside [-1,1]
+    if c > 1.0:
+        c = 1.0
+    elif c < -1.0:
+        c = -1.0
+    return c
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef double[::1] row_norms(const floating_t[:, ::1] X):
+    cdef Py_ssize_t i,k
+    cdef double s
+    cdef double[::1] norms = np.empty(X.shape[0],dtype=np.float64)
+    for i in prange(X.shape[0],nogil=True,schedule='static'):
+        s = 0.0
+        for k in range(X.shape[1]):
+            s = s + X[i,k] * X[i,k]
+        # Zero vectors get a unit norm so that their similarities are defined
+        norms[i] = sqrt(s) if s > 0.0 else 1.0
+    return norms
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def angular_similarity_matrix(const floating_t[:, ::1] A, const floating_t[:, ::1] B):
+    """
+    Compute the angular similarity between every row of A and every row of B.
+    Rows of A are processed in parallel with the GIL released.
+    param A: C-contiguous matrix of vectors.
+    param B: C-contiguous matrix of vectors with the same type and number of columns as A.
+    return: float64 matrix with a row per row of A and a column per row of B
+    """
+    if A.shape[1] != B.shape[1]:
+        raise ValueError('A and B must have the same number of columns')
+    cdef Py_ssize_t i,j
+    cdef double[::1] a_norms = row_norms(A)
+    cdef double[::1] b_norms = row_norms(B)
+    result = np.empty((A.shape[0],B.shape[0]),dtype=np.float64)
+    cdef double[:, ::1] S = result
+    for i in prange(A.shape[0],nogil=True,schedule='static'):
+        for j in range(B.shape[0]):
+            S[i,j] = 1.0 - acos(cosine_similarity(A,i,B,j,a_norms,b_norms)) / M_PI
+    return result
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def angular_similarity_hits(const floating_t[:, ::1] A, const floating_t[:, ::1] B, double threshold):
+    """
+    Find the rows of B whose angular similarity to at least one row of A is at or above threshold.
+    The threshold is applied in cosine space so no arccos is computed. Rows of B are processed in parallel with
+    the GIL released and each row stops at its first hit.
+    param A: C-contiguous matrix of vectors, e.g. SAT segment encodings.
+    param B: C-contiguous matrix of vectors with the same type and number of columns as A, e.g. corpus encodings.
+    param threshold: Angular similarity threshold.
+    return: uint8 vector with a 1 for each row of B that is a hit
+    """
+    if A.shape[1] != B.shape[1]:
+        raise ValueError('A and B must have the same number of columns')
+    cdef Py_ssize_t i,j
+    cdef double cos_threshold = cos(M_PI * (1.0 - threshold))
+    cdef double[::1] a_norms = row_norms(A)
+    cdef double[::1] b_norms = row_norms(B)
+    result = np.zeros(B.shape[0],dtype=np.uint8)
+    cdef unsigned char[::1] hits = result
+    for j in prange(B.shape[0],nogil=True,schedule='static'):
+        for i in range(A.shape[0]):
+            if cosine_similarity(A,i,B,j,a_norms,b_norms) >= cos_threshold:
+                hits[j] = 1
+                break
+    return result
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def angular_similarity_pdist(const floating_t[:, ::1] X):
+    """
+    Compute the angular similarity between every pair of rows of X in scipy pdist() condensed order.
+    Rows are processed in parallel with the GIL released.
+    param X: C-contiguous matrix of vectors.
+    return: float64 vector of length n(n-1)/2 where n is the number of rows of X
+    """
+    cdef Py_ssize_t n = X.shape[0]
+    cdef Py_ssize_t i,j,offset
+    cdef double[::1] norms = row_norms(X)
+    result = np.empty(n * (n - 1) // 2,dtype=np.float64)
+    cdef double[::1] D = result
+    # Dynamic scheduling because early rows have more pairs than late rows
+    for i in prange(n,nogil=True,schedule='dynamic'):
+        offset = i * n - i * (i + 1) // 2 - i - 1
+        for j in range(i + 1,n):
+            D[offset + j] = 1.0 - acos(cosine_similarity(X,i,X,j,norms,norms)) / M_PI
+    return result
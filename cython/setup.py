@@ -1,10 +1,27 @@
 from distutils.core import Extension, setup
 from Cython.Build import cythonize
 import numpy
+import sys
+
+# The matrix kernels use OpenMP to run over all cores. Apple clang does not ship OpenMP so on a Mac the kernels
+# are built single-threaded unless libomp is installed and ANGULAR_DISTANCE_OPENMP=1 is set.
+if sys.platform == 'darwin':
+    import os
+    if os.environ.get('ANGULAR_DISTANCE_OPENMP') == '1':
+        openmp_compile_args = ['-Xpreprocessor', '-fopenmp']
+        openmp_link_args = ['-lomp']
+    else:
+        openmp_compile_args = []
+        openmp_link_args = []
+else:
+    openmp_compile_args = ['-fopenmp']
+    openmp_link_args = ['-fopenmp']
 
 # define an extension that will be cythonized and compiled
 ext = Extension(name="angular_distance", sources=["angular_distance.pyx"],
                 include_dirs=[numpy.get_include()],
-                define_macros=[('NPY_NO_DEPRECATED_API', 'NPY_1_7_API_VERSION')])
+                define_macros=[('NPY_NO_DEPRECATED_API', 'NPY_1_7_API_VERSION')],
+                extra_compile_args=['-O3'] + openmp_compile_args,
+                extra_link_args=openmp_link_args)
 setup(ext_modules=cythonize(ext, language_level = "3"))
 
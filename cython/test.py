@@ -1,8 +1,11 @@
 
 import angular_distance as ad
+import os
+import tempfile
 import time
 import random
 import numpy as np
+from scipy.spatial.distance import cdist
 
 
 v = np.array([random.uniform(-5.0,5.0) for _ in range(10000)])
@@ -15,3 +18,71 @@ t = t2-t1
 print("%.10f" % t, "seconds")
 print(distance)
 
+# Throughput benchmark of the matrix kernels against the scalar kernel called by cdist.
+# Rows are SAT-sized query sets and columns are corpus sizes, with USE-sized (512) encodings.
+dimensions = 512
+query_count = 50
+corpus_sizes = [1000, 10000, 100000]
+threshold = 0.72
+
+def throughput(pair_count, seconds):
+    return pair_count / seconds / 1e6 if seconds > 0 else float('inf')
+
+rng = np.random.default_rng(0)
+print()
+print('Kernel                       dtype     Corpus   Seconds  Mpairs/s')
+for corpus_size in corpus_sizes:
+    corpus = rng.normal(size=(corpus_size, dimensions))
+    queries = corpus[:query_count].copy()
+    pair_count = query_count * corpus_size
+
+    # The scalar kernel is slow so it is only timed on a slice of the corpus
+    sample_size = min(corpus_size, 10000)
+    t1 = time.time()
+    reference = cdist(queries, corpus[:sample_size], ad.angular_distance)
+    t2 = time.time()
+    print(f'{"cdist(angular_distance)":28s} {"float64":8s} {corpus_size:7d} {t2 - t1:9.3f} '
+          f'{throughput(query_count * sample_size, t2 - t1):9.2f}')
+
+    for dtype in [np.float64, np.float32]:
+        A = np.ascontiguousarray(queries, dtype=dtype)
+        B = np.ascontiguousarray(corpus, dtype=dtype)
+
+        t1 = time.time()
+        similarities = ad.angular_similarity_matrix(A, B)
+        t2 = time.time()
+        assert np.allclose(similarities[:, :sample_size], reference, atol=1e-6)
+        print(f'{"angular_similarity_matrix":28s} {np.dtype(dtype).name:8s} {corpus_size:7d} {t2 - t1:9.3f} '
+              f'{throughput(pair_count, t2 - t1):9.2f}')
+
+        t1 = time.time()
+        hits = ad.angular_similarity_hits(A, B, threshold)
+        t2 = time.time()
+        assert np.array_equal(hits.astype(bool), np.any(similarities >= threshold, axis=0))
+        print(f'{"angular_similarity_hits":28s} {np.dtype(dtype).name:8s} {corpus_size:7d} {t2 - t1:9.3f} '
+              f'{throughput(pair_count, t2 - t1):9.2f}')
+
+    # Model encodings are memory-mapped read-only with np.load(..., mmap_mode='r') and must be accepted as they are
+    filename = os.path.join(tempfile.mkdtemp(), 'segment_encodings.npy')
+    np.save(filename, corpus.astype(np.float32))
+    mapped = np.load(filename, mmap_mode='r')
+    A = np.ascontiguousarray(queries, dtype=np.float32)
+    t1 = time.time()
+    hits = ad.angular_similarity_hits(A, mapped, threshold)
+    t2 = time.time()
+    assert not mapped.flags.writeable
+    assert np.array_equal(hits, ad.angular_similarity_hits(A, np.array(mapped), threshold))
+    assert np.allclose(ad.angular_similarity_matrix(A, mapped[:sample_size]), reference, atol=1e-6)
+    print(f'{"angular_similarity_hits mmap":28s} {"float32":8s} {corpus_size:7d} {t2 - t1:9.3f} '
+          f'{throughput(pair_count, t2 - t1):9.2f}')
+    del mapped
+    os.remove(filename)
+
+    # pdist is quadratic so it is benchmarked on at most 5000 rows
+    rows = min(corpus_size, 5000)
+    X = np.ascontiguousarray(corpus[:rows], dtype=np.float32)
+    t1 = time.time()
+    condensed = ad.angular_similarity_pdist(X)
+    t2 = time.time()
+    print(f'{"angular_similarity_pdist":28s} {"float32":8s} {rows:7d} {t2 - t1:9.3f} '
+          f'{throughput(len(condensed), t2 - t1):9.2f}')
@@ -0,0 +1,96 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+
+__author__      = 'Roy Gardner'
+__copyright__   = 'Copyright 2025, Roy Gardner and Sally Gardner'
+
+"""
+Client of the local encoder service (see encoder_service.py) and encoder versions.
+
+This is the only implementation of the client and of encoder versions. It is used by the processing pipeline and
+loaded from this folder by the analysis library (see analysis/_library/server.py), so it only imports the standard
+library and numpy and not either folder's packages module.
+"""
+
+import hashlib
+import json
+import os
+import socket
+import urllib.request
+
+import numpy as np
+
+ENCODER_SERVICE_PORT = 8003
+
+# Encoder versions keyed by encoder path, so that a saved model is only hashed once per session
+encoder_versions = {}
+
+def hash_file(filename,block_size=1024 * 1024):
+    """
+    Compute the SHA-256 hash of a file's content.
+    param filename: Path to the file.
+    param block_size: Number of bytes read at a time.
+    return: Hex digest
+    """
+    sha = hashlib.sha256()
+    with open(filename,'rb') as f:
+        for block in iter(lambda: f.read(block_size),b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def get_encoder_version(encoder_path):
+    """
+    Identify an encoder by the content of its saved model so that encodings and query embeddings can be shared between
+    copies of the same encoder at different paths.
+    param encoder_path: Path to the encoder.
+    return: Hex digest, or the real path if the encoder has no saved_model.pb
+    """
+    encoder_path = os.path.realpath(encoder_path)
+    if not encoder_path in encoder_versions:
+        filename = os.path.join(encoder_path,'saved_model.pb')
+        encoder_versions[encoder_path] = hash_file(filename) if os.path.exists(filename) else encoder_path
+    return encoder_versions[encoder_path]
+
+class RemoteEncoder:
+    """
+    Client of the local encoder service. Instances are called like an encoder loaded with hub.load() so that
+    encode_segments() and the analysis notebook can use either.
+    """
+    def __init__(self,encoder_path,port=ENCODER_SERVICE_PORT,timeout=600):
+        """
+        param encoder_path: Path to an encoder hosted by the service.
+        param port: Port of the service on localhost.
+        param timeout: Seconds to wait for a response.
+        """
+        self.encoder_path = os.path.realpath(encoder_path)
+        self.port = port
+        self.timeout = timeout
+
+    def __call__(self,text_list):
+        """
+        Encode texts.
+        param text_list: A list of strings.
+        return: A float32 matrix with an encoding per string
+        """
+        body = json.dumps({'encoder':self.encoder_path,'texts':list(text_list)}).encode('utf-8')
+        request = urllib.request.Request(f'http://localhost:{self.port}/encode',data=body,\
+                                         headers={'Content-Type':'application/json'})
+        with urllib.request.urlopen(request,timeout=self.timeout) as response:
+            shape = (int(response.headers['X-Rows']),int(response.headers['X-Dimensions']))
+            return np.frombuffer(response.read(),dtype=np.float32).reshape(shape)
+
+def encoder_service_hosts(encoder_path,port=ENCODER_SERVICE_PORT):
+    """
+    Check whether the local encoder service is running and hosts an encoder.
+    param encoder_path: Path to the encoder.
+    param port: Port of the service on localhost.
+    return: True if the service can encode with the encoder
+    """
+    with socket.socket(socket.AF_INET,socket.SOCK_STREAM) as sock:
+        if sock.connect_ex(('localhost',port)) != 0:
+            return False
+    try:
+        with urllib.request.urlopen(f'http://localhost:{port}/encoders',timeout=5) as response:
+            return os.path.realpath(encoder_path) in json.loads(response.read())
+    except Exception:
+        return False
@@ -0,0 +1,181 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+
+__author__      = 'Roy Gardner'
+__copyright__   = 'Copyright 2025, Roy Gardner and Sally Gardner'
+
+"""
+Long-lived local encoder service shared by notebooks and the processing pipeline.
+
+Loading an encoder takes several seconds and about a gigabyte of memory. The service loads each encoder once and
+serves encodings over HTTP on localhost, so notebook kernels and pipeline runs don't load their own copies.
+Concurrent requests for the same encoder are micro-batched: requests arriving within a few milliseconds of each
+other are encoded in one encoder call.
+
+Start the service from the processing folder with the encoders it should host, e.g.:
+
+python encoder_service.py --encoder ../encoders/use-4/ --encoder ../encoders/use_ml_3/
+
+The client is RemoteEncoder in encoder_client.py, which the analysis library also uses. Pipeline configurations use
+the service if their 'encoder_service' port is set and the service hosts their encoder. The analysis notebook
+uses it if it hosts the model's encoder. Otherwise encoders are loaded in process as before.
+
+Endpoints:
+
+GET /encoders: JSON list of the encoder paths hosted by the service.
+POST /encode: JSON body {"encoder": path, "texts": [...]}. The response is a float32 matrix in native byte order
+with its shape in the X-Rows and X-Dimensions headers.
+"""
+
+from packages import *
+from encoder_client import ENCODER_SERVICE_PORT
+
+class MicroBatcher:
+    """
+    Serialises requests for one encoder through a single thread that merges queued requests into batches.
+    """
+    def __init__(self,encoder,max_batch_size=512,max_wait=0.005):
+        """
+        param encoder: The encoder, e.g. USE v4.
+        param max_batch_size: Number of texts at which a batch is closed without waiting.
+        param max_wait: Seconds to wait for more requests after the first request of a batch arrives.
+        """
+        self.encoder = encoder
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.thread = Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def encode(self,texts):
+        """
+        Encode texts, blocking until the batch containing them has been encoded.
+        param texts: A list of strings.
+        return: A float32 matrix with an encoding per string
+        """
+        request = {'texts':texts,'done':Event(),'encodings':None,'error':None}
+        self.requests.put(request)
+        request['done'].wait()
+        if request['error'] is not None:
+            raise request['error']
+        return request['encodings']
+
+    def run(self):
+        while True:
+            batch = [self.requests.get()]
+            count = len(batch[0]['texts'])
+            deadline = time.time() + self.max_wait
+            while count < self.max_batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                count += len(request['texts'])
+
+            texts = [text for request in batch for text in request['texts']]
+            try:
+                encodings = np.asarray(self.encoder(texts),dtype=np.float32) if len(texts) > 0 else None
+                start = 0
+                for request in batch:
+                    end = start + len(request['texts'])
+                    if encodings is None or end == start:
+                        request['encodings'] = np.zeros((0,0),dtype=np.float32)
+                    else:
+                        request['encodings'] = encodings[start:end]
+                    start = end
+            except Exception as e:
+                for request in batch:
+                    request['error'] = e
+            for request in batch:
+                request['done'].set()
+
+class EncoderServiceHandler(BaseHTTPRequestHandler):
+    def __init__(self, batchers, *args, **kwargs):
+        self.batchers = batchers
+        super().__init__(*args, **kwargs)
+
+    def log_message(self, format, *args):
+        # Requests are too frequent to log
+        pass
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/encoders':
+            self.send_json(404, {'error': 'Unknown endpoint'})
+            return
+        self.send_json(200, sorted(self.batchers.keys()))
+
+    def do_POST(self):
+        if self.path != '/encode':
+            self.send_json(404, {'error': 'Unknown endpoint'})
+            return
+        try:
+            content_length = int(self.headers['Content-Length'])
+            data = json.loads(self.rfile.read(content_length))
+            encoder_path = os.path.realpath(data['encoder'])
+            texts = [str(text) for text in data['texts']]
+        except Exception:
+            self.send_json(400, {'error': 'Expected a JSON body with encoder and texts fields'})
+            return
+        if not encoder_path in self.batchers:
+            self.send_json(404, {'error': f'The service does not host {encoder_path}'})
+            return
+        try:
+            encodings = self.batchers[encoder_path].encode(texts)
+        except Exception as e:
+            self.send_json(500, {'error': str(e)})
+            return
+        body = np.ascontiguousarray(encodings,dtype=np.float32).tobytes()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('X-Rows', str(encodings.shape[0]))
+        self.send_header('X-Dimensions', str(encodings.shape[1]))
+        self.end_headers()
+        self.wfile.write(body)
+
+def serve(encoder_paths,port=ENCODER_SERVICE_PORT,max_batch_size=512,max_wait=0.005):
+    """
+    Load encoders and serve them on localhost until interrupted.
+    param encoder_paths: List of paths to encoders.
+    param port: Port on localhost.
+    param max_batch_size: See MicroBatcher.
+    param max_wait: See MicroBatcher.
+    """
+    batchers = {}
+    for encoder_path in encoder_paths:
+        print(f'Loading {encoder_path}')
+        batchers[os.path.realpath(encoder_path)] = MicroBatcher(hub.load(encoder_path),max_batch_size=max_batch_size,\
+                                                                max_wait=max_wait)
+    handler = lambda *args: EncoderServiceHandler(batchers, *args)
+    server = ThreadingHTTPServer(('localhost', port), handler)
+    server.daemon_threads = True
+    print('Encoder service running on port:', port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Serve encoders to notebooks and the processing pipeline.')
+    parser.add_argument('--encoder', action='append', required=True, help='Path to an encoder. May be repeated.')
+    parser.add_argument('--port', type=int, default=ENCODER_SERVICE_PORT, help='Port on localhost.')
+    parser.add_argument('--max_batch_size', type=int, default=512, help='Texts at which a batch is closed.')
+    parser.add_argument('--max_wait', type=float, default=0.005, help='Seconds to wait for requests to batch.')
+    args = parser.parse_args()
+
+    serve(args.encoder, port=args.port, max_batch_size=args.max_batch_size, max_wait=args.max_wait)
@@ -4,16 +4,22 @@
 
 import angular_distance as ad
 
+import argparse
 import csv
 from datetime import datetime, timedelta
 from decimal import *
 
 from lxml import etree
+import hashlib
 import html
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import itertools
 
 import json
+from multiprocessing import Pool
 import numpy as np
 import os
+import queue
 import random
 import re
 import sys
@@ -21,10 +27,13 @@ import pandas as pd
 
 import scipy as sp
 from scipy.spatial.distance import *
+from scipy.sparse import csr_matrix
 
 import spacy
 from spacy.lang.en import English
 from spacy.language import Language 
+import sqlite3
+import socket
 import string
 
 import tensorflow as tf
@@ -32,5 +41,7 @@ import tensorflow_hub as hub
 
 import textract
 
+from threading import Event, Thread
 import time
 import tensorflow_text
+import urllib.request
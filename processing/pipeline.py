@@ -33,6 +33,19 @@ Configuration dictionaries supply the following fields for all file types:
 'label': Name of process.
 'description':Description of process.
 
+The following optional fields build additional model files once a processor has finished:
+
+'ann_index': True|False. True to build an ANN index (ann_index.npz) for similarity range queries.
+'ann_lists': Number of ANN index lists. 0 or missing uses the square root of the number of segments.
+An ANN index from an earlier run is removed before the encodings are rewritten, so False removes it.
+'neighbour_graph': True|False. True to precompute a sparse graph (neighbour_graph.npz) of all segment pairs at or
+above the lowest slider threshold, which turns SAT expansion into a lookup.
+'neighbour_graph_size': Largest neighbour graph in bytes. Defaults to 2 GB. Larger graphs are not written.
+A neighbour graph from an earlier run is removed before the encodings are rewritten, so False removes it.
+'quantisation': ''|'int8'|'float16'. If set, writes quantised encodings (segment_encodings_q.npy) which searches scan
+before rescoring survivors at full precision. 'int8' is a quarter of the size of the float32 encodings. Quantised
+encodings from an earlier run are removed before the encodings are rewritten, so unset removes them.
+
 The configuration for CCP XML files contain this customisable field:
 'element_types': ['body','list'] which define the XML elements containing the text sections that are encoded.
 
@@ -40,6 +53,23 @@ The configurations for CCP XML files contain these customisable fields:
 'data_fields': A list of names of columns that contain text to process.
 'id_field': The column name to use as a row identifier. If empty or missing the row number is used.
 
+All configurations accept these optional fields:
+'n_process': Number of processes used for spaCy segmentation or constitution XML parsing. 0 or missing uses 4, or
+the number of available cores if fewer. Every segmentation process loads its own copy of the spaCy model (roughly
+0.5-1 GB for the _lg models), so peak memory grows with n_process.
+'encode_token_budget': Maximum number of padded tokens in an encoder batch. Segments are batched by length so that
+short segments go in large batches and long segments in small ones. 0 or missing uses 8192. Larger budgets use more
+encoder memory per batch and usually encode faster.
+'incremental': True|False. If True or missing, only new or changed source files are processed and the rest of the
+model is reused from the previous run, using the file hashes recorded in manifest.json. False forces a full rebuild.
+'encoder_service': Port of the local encoder service (see encoder_service.py), 8003 unless the service was started
+with --port. If the service is running and hosts the configuration's encoder, segments are encoded by the service
+instead of loading the encoder. 0 or missing loads the encoder without contacting the service.
+'embedding_cache': Path to an SQLite embedding cache keyed by encoder and segment text, e.g.,
+'../model/embedding_cache.sqlite', which can be shared by several configurations. Text found in the cache is not
+re-encoded. Empty or missing disables the cache. The cache grows up to 'embedding_cache_size'.
+'embedding_cache_size': Maximum size in bytes of the encodings held by the cache. Defaults to 2GB.
+
 NOTE: Excel and CSV fields must contain a header row containing column names.
 
 """
@@ -50,6 +80,8 @@ import process_xlsx
 import process_csv
 
 from packages import *
+from utilities import validate_paths,build_ann_index,build_neighbour_graph,quantise_encodings,\
+    remove_model_files,report_embedding_caches
 
 def main(config):
 
@@ -57,7 +89,18 @@ def main(config):
         if process_config['run'] == True:
             print('\n')
             print(f"Processing {process_config['label']}\n")
+            _,model_path,_,_ = validate_paths(process_config)
+            # Files built from the encodings are removed before the encodings are rewritten and rebuilt if enabled
+            remove_model_files(model_path,['ann_index.npz','neighbour_graph.npz','segment_encodings_q.npy',\
+                                           'segment_encodings_q_parameters.npy'])
             process_config['processor'].process(process_config)
+            if process_config.get('ann_index',False):
+                build_ann_index(model_path,list_count=process_config.get('ann_lists',0))
+            if process_config.get('neighbour_graph',False):
+                build_neighbour_graph(model_path,max_bytes=process_config.get('neighbour_graph_size',2 * 1024 ** 3))
+            if len(process_config.get('quantisation','')) > 0:
+                quantise_encodings(model_path,quantisation=process_config['quantisation'])
+    report_embedding_caches()
 
 if __name__ == '__main__':
 
@@ -72,6 +115,11 @@ if __name__ == '__main__':
         'encoder_path': '../encoders/use-4/',
         'spacy_path': '',
         'element_types': ['body','list'], # The XML elements we are processing
+        'ann_index': False, # Set to True to build an ANN index for range queries
+        'neighbour_graph': False, # Set to True to precompute the neighbour graph used by expansion
+        'quantisation': '', # Set to 'int8' or 'float16' to scan quantised encodings before rescoring
+        'encoder_service': 0, # Set to 8003 to use encoder_service.py if it is running with this encoder
+        'embedding_cache': '', # Path to an SQLite embedding cache, e.g., '../model/embedding_cache.sqlite'
         'label': 'CCP constitutions',
         'description':'Encoding sections in XML constitutions. Segmentation is not required.'
     }
@@ -84,6 +132,11 @@ if __name__ == '__main__':
         'model_path': '../model/anarchism/',
         'encoder_path': '../encoders/use-4/',
         'spacy_path': '../spaCy models/en_core_web_lg-3.8.0/',
+        'ann_index': False, # Set to True to build an ANN index for range queries
+        'neighbour_graph': False, # Set to True to precompute the neighbour graph used by expansion
+        'quantisation': '', # Set to 'int8' or 'float16' to scan quantised encodings before rescoring
+        'encoder_service': 0, # Set to 8003 to use encoder_service.py if it is running with this encoder
+        'embedding_cache': '', # Path to an SQLite embedding cache, e.g., '../model/embedding_cache.sqlite'
         'label': 'Anarchist contracts and manifestos',
         'description':'Segmenting and encoding anarchist documentation.'
     }
@@ -98,6 +151,11 @@ if __name__ == '__main__':
         'spacy_path': '../spaCy models/es_core_news_lg-3.8.0/',
         'data_fields':['text'],
         'id_field':'', # If empty row ID defaults to row number
+        'ann_index': False, # Set to True to build an ANN index for range queries
+        'neighbour_graph': False, # Set to True to precompute the neighbour graph used by expansion
+        'quantisation': '', # Set to 'int8' or 'float16' to scan quantised encodings before rescoring
+        'encoder_service': 0, # Set to 8003 to use encoder_service.py if it is running with this encoder
+        'embedding_cache': '', # Path to an SQLite embedding cache, e.g., '../model/embedding_cache.sqlite'
         'label': 'Chilean plenary session transcripts (Excel)',
         'description':'Segmenting and encoding Spanish-language transcripts in Excel files.'
     }
@@ -112,6 +170,11 @@ if __name__ == '__main__':
         'spacy_path': '../spaCy models/es_core_news_lg-3.8.0/',
         'data_fields':['text'],
         'id_field':'', # If empty row ID defaults to row number
+        'ann_index': False, # Set to True to build an ANN index for range queries
+        'neighbour_graph': False, # Set to True to precompute the neighbour graph used by expansion
+        'quantisation': '', # Set to 'int8' or 'float16' to scan quantised encodings before rescoring
+        'encoder_service': 0, # Set to 8003 to use encoder_service.py if it is running with this encoder
+        'embedding_cache': '', # Path to an SQLite embedding cache, e.g., '../model/embedding_cache.sqlite'
         'label': 'Chilean plenary session transcripts (CSV)',
         'description':'Segmenting and encoding Spanish-language transcripts in CSV files.'
     }
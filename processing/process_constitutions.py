@@ -10,8 +10,10 @@ Generates following model files from constitution XML:
 
 - documents_dict.json
 - segments_dict.json
-- segment_encodings.json
+- segment_encodings.npy
 - encoded_segments.json
+- segment_texts.bin and segment_text_offsets.npy
+- manifest.json
 
 Also serialises configuration dictionary into config.json
 
@@ -22,6 +24,88 @@ This process DOES NOT segment constitution sections.
 from packages import *
 from utilities import *
 
+def parse_constitution(task):
+    """
+    Parse a constitution XML file in a single streaming pass, capturing the elements of every configured type.
+    Segments are returned in the order of element types and then document order, i.e., the order of a separate
+    findall() per element type.
+    param task: Tuple of XML file path and list of element types. A tuple so that the function can be mapped over a pool.
+    return: Tuple of a list of (segment_id, text) tuples and a list of (constitution_id, section_id, error) tuples
+    """
+    xml_file,element_types = task
+    constitution_id = os.path.splitext(os.path.basename(xml_file))[0]
+
+    # Results are bucketed by element type and keyed by the position of the element's start tag (document order)
+    # because end events, when content is available, arrive children first
+    type_positions = {}
+    for position,type_ in enumerate(element_types):
+        type_positions.setdefault(type_,[]).append(position)
+    buckets = [[] for _ in element_types]
+    # Start positions of the captured elements that have not ended yet
+    start_order = {}
+    start_count = 0
+
+    for event,elem in etree.iterparse(xml_file,events=('start','end')):
+        type_ = elem.get('type')
+        captured = type_ in type_positions and elem.getparent() is not None
+        if event == 'start':
+            if captured:
+                start_order[elem] = start_count
+                start_count += 1
+            continue
+
+        if captured:
+            section_id = elem.get('uri').split('/')[1]
+            # Get the section ID which we are calling the segment_id because of data model conventions
+            segment_id = constitution_id + '/' + section_id
+
+            items = []
+            # Content contains the text
+            for content_elem in elem.findall('content'):
+                if 'en' in content_elem.values():
+                    text = content_elem.text
+                    if text == None:
+                        items.append((None,(constitution_id,section_id,'Element text = None')))
+                        continue
+                    if not type(text) == str:
+                        items.append((None,(constitution_id,section_id,'Element text not a string')))
+                        continue
+                    else:
+                        text = html.unescape(text)
+                    if len(text.strip()) == 0:
+                        items.append((None,(constitution_id,section_id,'Element text is empty')))
+                        continue
+                    items.append(((segment_id,text.strip()),None))
+
+            order = start_order.pop(elem)
+            for position in type_positions[type_]:
+                buckets[position].append((order,items))
+
+        # Text is read when a captured element ends, so an ended element is no longer needed unless it is the
+        # content of a captured element that has not ended. Other ended elements are cleared, and removed with their
+        # earlier siblings if none of those can be content still to be read, so that memory is bounded by the depth
+        # of the tree rather than the size of the file
+        parent = elem.getparent()
+        if parent is None:
+            continue
+        if not parent in start_order:
+            elem.clear()
+            while elem.getprevious() is not None:
+                del parent[0]
+        elif elem.tag != 'content':
+            elem.clear()
+
+    segments = []
+    errors = []
+    for bucket in buckets:
+        for _,items in sorted(bucket,key=lambda item: item[0]):
+            for segment,error in items:
+                if segment is not None:
+                    segments.append(segment)
+                else:
+                    errors.append(error)
+    return segments,errors
+
 def process(config):
 
     error_list = []
@@ -32,48 +116,33 @@ def process(config):
 
     data_path,model_path,encoder_path,_ = validate_paths(config)
 
-    encoder = hub.load(encoder_path)
-
     _, _, files = next(os.walk(data_path))
     files = [f for f in files if not f[0] == '.']
 
+    # Only new or changed files are parsed and encoded
+    update = ModelUpdate(config,data_path,model_path,files)
+    encoder = load_encoder(config,encoder_path) if len(update.changed) > 0 else None
+
     print('Segmenting…')
-    for i, file in enumerate(files):
+    tasks = [(data_path + file,config['element_types']) for file in update.changed]
+    n_process = min(get_process_count(config),max(len(tasks),1))
+    if n_process > 1:
+        with Pool(n_process) as pool:
+            # imap returns results in file order so the merge is deterministic
+            results = list(pool.imap(parse_constitution,tasks))
+    else:
+        results = [parse_constitution(task) for task in tasks]
+
+    for file,(segments,errors) in zip(update.changed,results):
         constitution_id = os.path.splitext(file)[0]
         documents_dict[constitution_id] = {}
         documents_dict[constitution_id]['name'] = constitution_id
+        for segment_id,text in segments:
+            segments_dict[segment_id] = {}
+            segments_dict[segment_id]['text'] = text
+        update.add(file,documents=[constitution_id],segments=[segment_id for segment_id,_ in segments],errors=errors)
 
-        xml_file = data_path + file
-        tree = etree.parse(xml_file)
-        results = []
-        for type_ in config['element_types']:
-            search_str = ".//*[@type='" + type_ + "']"
-            results.extend(tree.findall(search_str))
-
-        for elem in results:
-            # Get the section ID which we are calling the segment_id because of data model conventions
-            segment_id = constitution_id + '/' + elem.get('uri').split('/')[1]
-
-            # Content contains the text
-            content = elem.findall('content')
-            if len(content) > 0:
-                for content_elem in content:
-                    if 'en' in content_elem.values():
-                        text = content_elem.text
-                        if text == None:
-                            error_list.append((constitution_id,elem.get('uri').split('/')[1],'Element text = None'))
-                            continue
-                        if not type(text) == str:
-                            error_list.append((constitution_id,elem.get('uri').split('/')[1],'Element text not a string'))
-                            continue
-                        else:
-                            text = html.unescape(text)
-                        if len(text.strip()) == 0:
-                            error_list.append((constitution_id,elem.get('uri').split('/')[1],'Element text is empty'))
-                            continue
-                        
-                        segments_dict[segment_id] = {}
-                        segments_dict[segment_id]['text'] = text.strip()
+    documents_dict,segments_dict = update.merge(documents_dict,segments_dict,error_list)
 
     # Write errors to disk
     model_filename = config['model_path'] + 'error_list.json'
@@ -81,9 +150,12 @@ def process(config):
         json.dump(error_list, outfile)
         outfile.close() 
 
-    segment_encodings,encoded_segments = encode_segments(segments_dict,encoder,split_size=100)
+    encoded_segments = encode_segments(iter_segments(segments_dict),encoder,model_path,len(segments_dict),\
+                                       token_budget=get_token_budget(config),reuse=update,\
+                                       cache=get_embedding_cache(config,encoder_path))
  
-    serialise_model(model_path,documents_dict,segments_dict,encoded_segments,segment_encodings,config)
+    serialise_model(model_path,documents_dict,segments_dict,encoded_segments,config)
+    update.save()
 
     if len(error_list) > 0:
         print(f'Finished processing. There were data source errors — see error_list.json in {model_path}')
@@ -9,8 +9,10 @@ Generates following model files from various document types using textract:
 
 - documents_dict.json
 - segments_dict.json
-- segment_encodings.json
+- segment_encodings.npy
 - encoded_segments.json
+- segment_texts.bin and segment_text_offsets.npy
+- manifest.json
 
 Document types include docx, PDF, and plain text.
 
@@ -28,7 +30,6 @@ def process(config):
 
     data_path,model_path,encoder_path,spacy_path = validate_paths(config)
 
-    encoder = hub.load(encoder_path)
     nlp = spacy.load(spacy_path)
     nlp.max_length = 3000000
 
@@ -44,35 +45,56 @@ def process(config):
             _,_,files = next(os.walk(type_path))   
             file_list.extend([(dir,f) for f in files if not f[0] == '.'])
  
-    print('Segmenting…')
-    for i, file_data in enumerate(file_list):
-
-        doc_id = os.path.splitext(file_data[1])[0]
-        documents_dict[doc_id] = {}
-        documents_dict[doc_id]['type'] = file_data[0]
-        documents_dict[doc_id]['name'] = file_data[1]
-
+    # Files are identified by their path relative to the data path
+    file_names = {}
+    for file_data in file_list:
         if len(file_data[0]) == 0:
-            file_name = data_path + file_data[1]
+            file_names[file_data[1]] = file_data
         else:
-            file_name = data_path + file_data[0] + '/' + file_data[1]
-
-        try:
-            text = textract.process(file_name).decode('utf-8')
-            doc = nlp(text, disable=['ner'])
-            for sent_index,sent in enumerate(doc.sents):
-                # Define a minimum word count
-                if get_word_count(sent) < 3:
-                    continue
-                segment_id = str(doc_id) + '/' + str(sent_index)
-                segments_dict[segment_id] = {}
-                segments_dict[segment_id]['text'] = sent.text
-        except:
-            print('ERROR',file_data)
-
-    segment_encodings,encoded_segments = encode_segments(segments_dict,encoder,split_size=500)
-
-    serialise_model(model_path,documents_dict,segments_dict,encoded_segments,segment_encodings,config)
+            file_names[file_data[0] + '/' + file_data[1]] = file_data
+
+    # Only new or changed files are segmented and encoded
+    update = ModelUpdate(config,data_path,model_path,list(file_names))
+    encoder = load_encoder(config,encoder_path) if len(update.changed) > 0 else None
+
+    def iter_texts():
+        # Generate the text of each document with its file and document ID as context
+        for file in update.changed:
+            file_data = file_names[file]
+
+            doc_id = os.path.splitext(file_data[1])[0]
+            documents_dict[doc_id] = {}
+            documents_dict[doc_id]['type'] = file_data[0]
+            documents_dict[doc_id]['name'] = file_data[1]
+            update.add(file,documents=[doc_id])
+
+            try:
+                text = textract.process(data_path + file).decode('utf-8')
+            except:
+                print('ERROR',file_data)
+                continue
+            yield text,(file,doc_id)
+
+    print('Segmenting…')
+    # Documents are large so they are sent to processes one at a time
+    for doc,(file,doc_id) in segment_texts(nlp,iter_texts(),config,batch_size=1):
+        for sent_index,sent in enumerate(doc.sents):
+            # Define a minimum word count
+            if get_word_count(sent) < 3:
+                continue
+            segment_id = str(doc_id) + '/' + str(sent_index)
+            segments_dict[segment_id] = {}
+            segments_dict[segment_id]['text'] = sent.text
+            update.add(file,segments=[segment_id])
+
+    documents_dict,segments_dict = update.merge(documents_dict,segments_dict)
+
+    encoded_segments = encode_segments(iter_segments(segments_dict),encoder,model_path,len(segments_dict),\
+                                       token_budget=get_token_budget(config),reuse=update,\
+                                       cache=get_embedding_cache(config,encoder_path))
+
+    serialise_model(model_path,documents_dict,segments_dict,encoded_segments,config)
+    update.save()
 
     print('Finished processing.')
 
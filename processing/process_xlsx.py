@@ -9,8 +9,10 @@ Generates following model files from Excel files:
 
 - documents_dict.json
 - segments_dict.json
-- segment_encodings.json
+- segment_encodings.npy
 - encoded_segments.json
+- segment_texts.bin and segment_text_offsets.npy
+- manifest.json
 
 Also serialises configuration dictionary into config.json
 
@@ -29,7 +31,6 @@ def process(config):
 
     data_path,model_path,encoder_path,spacy_path = validate_paths(config)
 
-    encoder = hub.load(encoder_path)
     nlp = spacy.load(spacy_path)
     nlp.max_length = 3000000
 
@@ -40,49 +41,63 @@ def process(config):
         _, _, files = next(os.walk(data_path))
         file_list = sorted([f for f in files if not f[0] == '.'])
 
-    print('Segmenting…')
-    for file in file_list:
-        xlsx_file = data_path + file
-        source = os.path.splitext(file)[0]  
-        rows = xlsx_to_rows_list(xlsx_file)
-
-        # Validate data and id fields
-        validate_xlxs_fields(rows[0],file,config)        
-
-        for i, row_dict in enumerate(rows):
-            if len(config['id_field'].strip()) == 0 or not config['id_field'] in row_dict:
-                row_id = str(i)
-            else:
-                row_id = str(row_dict[config['id_field']])
-
-            document_id = source + '/' + row_id
-
-            # Store the original row data as the row dictionary
-            documents_dict[document_id] = {}
-            documents_dict[document_id]['source'] = source
-            documents_dict[document_id]['data'] = row_dict
-
-            # Segment text in data fields into sentences
-            for _,field in enumerate(config['data_fields']):
-
-                text = row_dict[field]
-                if type(text) != str:
-                    continue
-                text = sanitise_string(text, lower=False)
-                if len(text) == 0:
-                    continue
-
-                doc = nlp(text, disable=['ner'])
-                for sent_index, sent in enumerate(doc.sents):
-                    clean = sanitise_string(sent.text)
-                    if len(clean) == 0:
-                        continue
-                    segment_id = f'{document_id}/{field}/{str(sent_index)}'
-                    segments_dict[segment_id] = {}
-                    segments_dict[segment_id]['text'] = clean
+    # Only new or changed files are segmented and encoded
+    update = ModelUpdate(config,data_path,model_path,file_list)
+    encoder = load_encoder(config,encoder_path) if len(update.changed) > 0 else None
+
+    def iter_texts():
+        # Generate the text of each data field with its document and field as context
+        for file in update.changed:
+            xlsx_file = data_path + file
+            source = os.path.splitext(file)[0]  
+            rows = xlsx_to_rows_list(xlsx_file)
+
+            # Validate data and id fields
+            validate_xlxs_fields(rows[0],file,config)        
+
+            for i, row_dict in enumerate(rows):
+                if len(config['id_field'].strip()) == 0 or not config['id_field'] in row_dict:
+                    row_id = str(i)
+                else:
+                    row_id = str(row_dict[config['id_field']])
+
+                document_id = source + '/' + row_id
 
-    segment_encodings,encoded_segments = encode_segments(segments_dict,encoder,split_size=100)
+                # Store the original row data as the row dictionary
+                documents_dict[document_id] = {}
+                documents_dict[document_id]['source'] = source
+                documents_dict[document_id]['data'] = row_dict
+                update.add(file,documents=[document_id])
 
-    serialise_model(model_path,documents_dict,segments_dict,encoded_segments,segment_encodings,config)
+                for _,field in enumerate(config['data_fields']):
+
+                    text = row_dict[field]
+                    if type(text) != str:
+                        continue
+                    text = sanitise_string(text, lower=False)
+                    if len(text) == 0:
+                        continue
+                    yield text,(file,document_id,field)
+
+    print('Segmenting…')
+    # Segment text in data fields into sentences
+    for doc,(file,document_id,field) in segment_texts(nlp,iter_texts(),config):
+        for sent_index, sent in enumerate(doc.sents):
+            clean = sanitise_string(sent.text)
+            if len(clean) == 0:
+                continue
+            segment_id = f'{document_id}/{field}/{str(sent_index)}'
+            segments_dict[segment_id] = {}
+            segments_dict[segment_id]['text'] = clean
+            update.add(file,segments=[segment_id])
+
+    documents_dict,segments_dict = update.merge(documents_dict,segments_dict)
+
+    encoded_segments = encode_segments(iter_segments(segments_dict),encoder,model_path,len(segments_dict),\
+                                       token_budget=get_token_budget(config),reuse=update,\
+                                       cache=get_embedding_cache(config,encoder_path))
+
+    serialise_model(model_path,documents_dict,segments_dict,encoded_segments,config)
+    update.save()
 
     print('Finished processing.')
@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 from packages import *
+from encoder_client import RemoteEncoder,encoder_service_hosts,hash_file,get_encoder_version
 
 class PathException(Exception):
   pass
@@ -59,24 +60,346 @@ def validate_csv_fields(header,file,config):
     if len(missing_fields) > 0:
         raise PathException(f'The following data fields {missing_fields} are missing from {file}')
 
-def encode_segments(segments_dict,encoder,split_size=80):
-    # Encode
+# Processes used when 'n_process' is not configured. Every process loads its own copy of the spaCy model, so the
+# default is kept low rather than scaling with the number of cores
+DEFAULT_PROCESS_COUNT = 4
+
+def get_process_count(config):
+    """
+    Get the number of processes used for segmentation or parsing from the optional 'n_process' configuration field.
+    param config: Processor configuration.
+    return: The configured number of processes or, if not configured, DEFAULT_PROCESS_COUNT or the number of available
+    cores if fewer
+    """
+    n_process = config.get('n_process',0)
+    if n_process <= 0:
+        n_process = min(DEFAULT_PROCESS_COUNT,os.cpu_count() or 1)
+    return n_process
+
+def segment_texts(nlp,texts,config,batch_size=64):
+    """
+    Stream texts through spaCy with nlp.pipe so that segmentation is batched and spread over processes.
+    param nlp: spaCy language model.
+    param texts: Iterable of (text, context) tuples. Context is passed through unchanged, e.g., row and field IDs.
+    param config: Processor configuration, see get_process_count().
+    param batch_size: Number of texts sent to a process at a time.
+    return: A generator of (doc, context) tuples in the order of texts
+    """
+    return nlp.pipe(texts,as_tuples=True,disable=['ner'],n_process=get_process_count(config),batch_size=batch_size)
+
+def iter_segments(segments_dict):
+    """
+    Generate (segment ID, text) tuples from a segments dictionary in insertion order.
+    param segments_dict: Dictionary with segment IDs as keys and dictionaries containing segment text as values.
+    """
+    for segment_id,segment in segments_dict.items():
+        yield segment_id,segment['text']
+
+def schedule_batches(lengths,token_budget=8192,max_batch_size=512):
+    """
+    Group segments of similar length into batches. Segments are sorted by token length and a batch is closed when
+    padding every segment to the longest in the batch would exceed the token budget, so batches of short segments
+    are large and batches of long segments are small.
+    param lengths: Token length of each segment.
+    param token_budget: Maximum number of (padded) tokens in a batch, which sets its memory use and latency.
+    param max_batch_size: Maximum number of segments in a batch.
+    return: A list of batches, each a list of positions in lengths
+    """
+    batches = []
+    batch = []
+    longest = 0
+    for position in np.argsort(lengths,kind='stable'):
+        length = max(1,int(lengths[position]))
+        if len(batch) > 0 and (max(longest,length) * (len(batch) + 1) > token_budget or len(batch) >= max_batch_size):
+            batches.append(batch)
+            batch = []
+            longest = 0
+        batch.append(position)
+        longest = max(longest,length)
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+def load_encoder(config,encoder_path):
+    """
+    Get an encoder, using the local encoder service named by the optional 'encoder_service' configuration field if it
+    is running and hosts the encoder, and otherwise loading the encoder into this process.
+    param config: Processor configuration.
+    param encoder_path: Path to the encoder.
+    return: A RemoteEncoder or an encoder loaded with hub.load()
+    """
+    port = config.get('encoder_service',0)
+    if port > 0 and encoder_service_hosts(encoder_path,port):
+        print(f'Using the encoder service on port {port}.')
+        return RemoteEncoder(encoder_path,port)
+    return hub.load(encoder_path)
+
+class EmbeddingCache:
+    """
+    Persistent content-addressed cache of encodings shared across models and pipeline runs.
+    Encodings are stored in an SQLite database keyed by encoder version and a hash of the exact segment text, so
+    text that recurs across documents or corpora is only encoded once per encoder. The least recently used encodings
+    are evicted when the cache exceeds its size limit.
+    """
+    def __init__(self,filename,encoder_path,max_bytes=2 * 1024 ** 3):
+        """
+        param filename: Path to the SQLite database, which is created if it doesn't exist.
+        param encoder_path: Path to the encoder, see get_encoder_version().
+        param max_bytes: Maximum size of the stored encodings.
+        """
+        self.filename = filename
+        self.encoder = get_encoder_version(encoder_path)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        directory = os.path.dirname(os.path.abspath(filename))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS embeddings (encoder TEXT, text_hash BLOB, encoding BLOB, '\
+                                'last_used REAL, PRIMARY KEY (encoder, text_hash)) WITHOUT ROWID')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)')
+        self.connection.commit()
+
+    def key(self,text):
+        """
+        Hash the text of a segment exactly as it is passed to the encoder, so that an encoding is only reused for
+        identical encoder input. The prefix keeps these keys apart from those of earlier versions of the cache, which
+        hashed normalised text.
+        param text: Segment text.
+        return: SHA-256 digest
+        """
+        return hashlib.sha256(b'text:' + text.encode('utf-8')).digest()
+
+    def get_many(self,texts,chunk_size=500):
+        """
+        Look up the encodings of texts and mark those found as recently used.
+        param texts: List of segment texts.
+        param chunk_size: Number of keys per query, which keeps queries within SQLite's parameter limit.
+        return: List with an encoding vector or None per text
+        """
+        keys = [self.key(text) for text in texts]
+        found = {}
+        for start in range(0,len(keys),chunk_size):
+            chunk = keys[start:start + chunk_size]
+            query = 'SELECT text_hash, encoding FROM embeddings WHERE encoder = ? AND text_hash IN (' + \
+                    ','.join(['?'] * len(chunk)) + ')'
+            for text_hash,encoding in self.connection.execute(query,[self.encoder] + chunk):
+                found[text_hash] = np.frombuffer(encoding,dtype=np.float32)
+        now = time.time()
+        self.connection.executemany('UPDATE embeddings SET last_used = ? WHERE encoder = ? AND text_hash = ?',\
+                                    [(now,self.encoder,key) for key in found])
+        encodings = [found.get(key) for key in keys]
+        hit_count = sum([encoding is not None for encoding in encodings])
+        self.hits += hit_count
+        self.misses += len(encodings) - hit_count
+        return encodings
+
+    def put_many(self,texts,encodings):
+        """
+        Store the encodings of texts.
+        param texts: List of segment texts.
+        param encodings: Matrix with an encoding per text.
+        """
+        now = time.time()
+        rows = [(self.encoder,self.key(text),np.asarray(encoding,dtype=np.float32).tobytes(),now) \
+                for text,encoding in zip(texts,encodings)]
+        self.connection.executemany('INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)',rows)
+
+    def commit(self):
+        """
+        Commit pending changes and evict least recently used encodings until the cache is within its size limit.
+        """
+        size = self.connection.execute('SELECT COALESCE(SUM(LENGTH(encoding)), 0) FROM embeddings').fetchone()[0]
+        if size > self.max_bytes:
+            cursor = self.connection.execute('SELECT encoder, text_hash, LENGTH(encoding) FROM embeddings '\
+                                             'ORDER BY last_used')
+            evicted = []
+            for encoder,text_hash,length in cursor:
+                if size <= self.max_bytes:
+                    break
+                evicted.append((encoder,text_hash))
+                size -= length
+            self.connection.executemany('DELETE FROM embeddings WHERE encoder = ? AND text_hash = ?',evicted)
+            self.evictions += len(evicted)
+        self.connection.commit()
+
+    def report(self):
+        """
+        Print hit-rate statistics for this run.
+        """
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups > 0 else 0.0
+        print(f'Embedding cache {self.filename}: {self.hits} hits, {self.misses} misses ({hit_rate:.1%} hit rate), '
+              f'{self.evictions} evictions.')
+
+# Embedding caches opened during a pipeline run, keyed by database path and encoder path
+embedding_caches = {}
+
+def get_embedding_cache(config,encoder_path):
+    """
+    Get the embedding cache named by the optional 'embedding_cache' configuration field.
+    param config: Processor configuration.
+    param encoder_path: Path to the encoder.
+    return: An EmbeddingCache or None if the configuration has no cache
+    """
+    filename = config.get('embedding_cache','')
+    if len(filename) == 0:
+        return None
+    key = (filename,encoder_path)
+    if not key in embedding_caches:
+        max_bytes = config.get('embedding_cache_size',2 * 1024 ** 3)
+        embedding_caches[key] = EmbeddingCache(filename,encoder_path,max_bytes=max_bytes)
+    return embedding_caches[key]
+
+def report_embedding_caches():
+    """
+    Print the statistics of every embedding cache used during a pipeline run.
+    """
+    for cache in embedding_caches.values():
+        cache.report()
+
+# Padded tokens per encoder batch when 'encode_token_budget' is not configured
+DEFAULT_TOKEN_BUDGET = 8192
+
+def get_token_budget(config):
+    """
+    Get the maximum number of padded tokens in an encoder batch from the optional 'encode_token_budget' configuration
+    field.
+    param config: Processor configuration.
+    return: The configured token budget or, if not configured, DEFAULT_TOKEN_BUDGET
+    """
+    token_budget = config.get('encode_token_budget',0)
+    if token_budget <= 0:
+        token_budget = DEFAULT_TOKEN_BUDGET
+    return token_budget
+
+def encode_segments(segments,encoder,model_path,segment_count,token_budget=DEFAULT_TOKEN_BUDGET,max_batch_size=512,\
+                    window_size=65536,reuse=None,cache=None,verbose=False):
+    """
+    Encode segments and write the encodings straight into the preallocated segment_encodings.npy matrix, so that
+    peak memory is bounded by a window of segments rather than the whole corpus.
+    Within each window segments are batched by token length (see schedule_batches()) and each batch is written to
+    the rows of its segments so the matrix keeps the original segment order.
+    The matrix is written under a temporary name and only replaces segment_encodings.npy once it is complete.
+    param segments: Iterable of (segment ID, text) tuples, e.g. iter_segments(segments_dict).
+    param encoder: The encoder, e.g. USE v4.
+    param model_path: Path to the model files.
+    param segment_count: Number of segments in segments.
+    param token_budget: Maximum number of (padded) tokens in a batch.
+    param max_batch_size: Maximum number of segments in a batch.
+    param window_size: Number of segments read and sorted at a time.
+    param reuse: Optional object whose lookup(segment_id,text) method returns an existing encoding or None,
+    e.g., a ModelUpdate. Segments with an existing encoding are not encoded.
+    param cache: Optional EmbeddingCache consulted for segments that are not reused. New encodings are added to it.
+    param verbose: If True print the throughput of every batch.
+    return: A list of segment IDs in encodings row order
+    """
     print('Encoding segments…')
-    encoded_segments = list(segments_dict.keys())
-    segments_text_list = [v['text'] for _,v in segments_dict.items()]
-    # Split the list so the encoder doesn't have to work too hard
-    split_list = np.array_split(segments_text_list,split_size)
+    encoded_segments = []
+    segment_encodings = None
+    tmp_filename = model_path + 'segment_encodings.tmp.npy'
+    batch_rates = []
+    start_time = time.time()
+
+    reused_count = 0
+    cached_count = 0
+    segments = iter(segments)
+    while True:
+        window = list(itertools.islice(segments,window_size))
+        if len(window) == 0:
+            break
+        row = len(encoded_segments)
+
+        pending = []
+        for position,(segment_id,text) in enumerate(window):
+            encoding = reuse.lookup(segment_id,text) if reuse is not None else None
+            if encoding is None:
+                pending.append(position)
+                continue
+            if segment_encodings is None:
+                segment_encodings = np.lib.format.open_memmap(tmp_filename,mode='w+',dtype=np.float32,\
+                                                              shape=(segment_count,len(encoding)))
+            segment_encodings[row + position] = encoding
+            reused_count += 1
+        pending = np.array(pending,dtype=np.int64)
+
+        if cache is not None and len(pending) > 0:
+            cached = cache.get_many([window[position][1] for position in pending])
+            found = np.array([encoding is not None for encoding in cached],dtype=bool)
+            if np.any(found):
+                if segment_encodings is None:
+                    dimensions = len(cached[int(np.argmax(found))])
+                    segment_encodings = np.lib.format.open_memmap(tmp_filename,mode='w+',dtype=np.float32,\
+                                                                  shape=(segment_count,dimensions))
+                segment_encodings[row + pending[found]] = np.stack([e for e in cached if e is not None])
+                cached_count += int(np.sum(found))
+            pending = pending[~found]
 
-    segment_encodings = []
-    for i,l in enumerate(split_list):
-        split = list(l)
-        encodings = encoder(split)
-        assert(len(encodings) == len(split))
-        segment_encodings.extend(np.array(encodings).tolist())
+        # Whitespace tokens are a cheap proxy for encoder tokens
+        lengths = np.array([len(window[position][1].split()) for position in pending])
+        for batch in schedule_batches(lengths,token_budget=token_budget,max_batch_size=max_batch_size):
+            positions = pending[batch]
+            t1 = time.time()
+            encodings = np.asarray(encoder([window[position][1] for position in positions]),dtype=np.float32)
+            t2 = time.time()
+            assert(len(encodings) == len(batch))
+            if segment_encodings is None:
+                segment_encodings = np.lib.format.open_memmap(tmp_filename,mode='w+',dtype=np.float32,\
+                                                              shape=(segment_count,encodings.shape[1]))
+            segment_encodings[row + positions] = encodings
+            if cache is not None:
+                cache.put_many([window[position][1] for position in positions],encodings)
+            rate = len(batch) / max(t2 - t1,1e-9)
+            batch_rates.append(rate)
+            if verbose:
+                print(f'Batch of {len(batch)} segments up to {lengths[batch].max()} tokens: {rate:.1f} segments/sec')
+        encoded_segments.extend([segment_id for segment_id,_ in window])
+        if cache is not None:
+            cache.commit()
 
-    return segment_encodings,encoded_segments
+    if len(encoded_segments) != segment_count:
+        raise ValueError(f'Expected {segment_count} segments but encoded {len(encoded_segments)}')
+    if segment_encodings is None:
+        np.save(tmp_filename,np.zeros((0,0),dtype=np.float32))
+    else:
+        segment_encodings.flush()
+        del segment_encodings
+    os.replace(tmp_filename,model_path + 'segment_encodings.npy')
 
-def serialise_model(model_path,documents_dict,segments_dict,encoded_segments,segment_encodings,config):
+    if reused_count > 0:
+        print(f'Reused {reused_count} existing encodings.')
+    if cached_count > 0:
+        print(f'Found {cached_count} encodings in the embedding cache.')
+    if len(batch_rates) > 0:
+        encoded_count = segment_count - reused_count - cached_count
+        elapsed = time.time() - start_time
+        print(f'Encoded {encoded_count} segments in {len(batch_rates)} batches at {encoded_count / elapsed:.1f} '
+              f'segments/sec (per batch min {min(batch_rates):.1f}, median {np.median(batch_rates):.1f}, '
+              f'max {max(batch_rates):.1f}).')
+    return encoded_segments
+
+def write_text_store(model_path,segments_dict,encoded_segments):
+    """
+    Write segment text as a single UTF-8 blob (segment_texts.bin) with an array of byte offsets
+    (segment_text_offsets.npy) so that the analysis library can memory-map text instead of loading segments_dict.json.
+    The text of the segment at row i of encoded_segments is blob[offsets[i]:offsets[i+1]].
+    param model_path: Path to the model files.
+    param segments_dict: Dictionary with segment IDs as keys and dictionaries containing segment text as values.
+    param encoded_segments: List of segment IDs in encodings row order.
+    """
+    offsets = np.zeros(len(encoded_segments) + 1,dtype=np.int64)
+    tmp_filename = model_path + 'segment_texts.tmp.bin'
+    with open(tmp_filename,'wb') as f:
+        for i,segment_id in enumerate(encoded_segments):
+            data = segments_dict[segment_id]['text'].encode('utf-8')
+            f.write(data)
+            offsets[i + 1] = offsets[i] + len(data)
+    np.save(model_path + 'segment_text_offsets.npy',offsets)
+    os.replace(tmp_filename,model_path + 'segment_texts.bin')
+
+def serialise_model(model_path,documents_dict,segments_dict,encoded_segments,config):
     print('Serialising model files…')
     model_filename = model_path + 'documents_dict.json'
     with open(model_filename, 'w') as f:
@@ -90,10 +413,7 @@ def serialise_model(model_path,documents_dict,segments_dict,encoded_segments,seg
     with open(model_filename, 'w') as f:
         json.dump(encoded_segments, f)
         f.close()
-    model_filename = model_path + 'segment_encodings.json'
-    with open(model_filename, 'w') as f:
-        json.dump(segment_encodings, f)
-        f.close()
+    write_text_store(model_path,segments_dict,encoded_segments)
     # Serialise the configuration without the processor module
     model_filename = model_path + 'config.json'
     _ = config.pop('processor')
@@ -101,6 +421,322 @@ def serialise_model(model_path,documents_dict,segments_dict,encoded_segments,seg
         json.dump(config, f)
         f.close()
 
+def config_signature(config):
+    """
+    Hash the configuration fields that determine the documents, segments, and encodings of a model. Fields that
+    only control how a model is built or what is built from it afterwards are ignored.
+    param config: Processor configuration.
+    return: Hex digest
+    """
+    ignored = ['run','processor','label','description','n_process','encode_token_budget','incremental',\
+               'encoder_service','embedding_cache','embedding_cache_size','ann_index','ann_lists','neighbour_graph',\
+               'neighbour_graph_size','quantisation']
+    fields = {key:value for key,value in config.items() if not key in ignored}
+    return hashlib.sha256(json.dumps(fields,sort_keys=True).encode('utf-8')).hexdigest()
+
+class ModelUpdate:
+    """
+    Incremental re-processing of a model.
+    manifest.json in the model path records a content hash of every source file together with the documents,
+    segments, and errors that the file produced. A processor only segments the files that are new or have changed
+    since the previous run and merge() takes the documents and segments of unchanged files from the previous model.
+    Files that no longer exist are dropped. Files are merged in source file order so the dictionaries are the same
+    as those of a full rebuild. encode_segments() reuses the previous encoding of any segment whose ID and text are
+    unchanged, including unchanged segments of changed files.
+    The previous model is ignored if the configuration has changed or the 'incremental' configuration field is False.
+    """
+    def __init__(self,config,data_path,model_path,files):
+        """
+        param config: Processor configuration.
+        param data_path: Path to the source files.
+        param model_path: Path to the model files.
+        param files: Source file names relative to data_path, in processing order.
+        """
+        self.model_path = model_path
+        self.files = files
+        self.signature = config_signature(config)
+        self.hashes = {file:hash_file(data_path + file) for file in files}
+        self.fresh = {}
+        self.manifest = {}
+
+        self.previous = {}
+        self.previous_documents = {}
+        self.previous_segments = {}
+        self.previous_rows = {}
+        self.previous_encodings = None
+        model_files = ['manifest.json','documents_dict.json','segments_dict.json','encoded_segments.json',\
+                       'segment_encodings.npy']
+        if config.get('incremental',True) and all([os.path.exists(model_path + f) for f in model_files]):
+            with open(model_path + 'manifest.json','r',encoding='utf-8') as f:
+                manifest = json.load(f)
+            if manifest['signature'] == self.signature:
+                self.previous = manifest['files']
+
+        self.changed = [file for file in files if not file in self.previous or \
+                        self.previous[file]['hash'] != self.hashes[file]]
+        deleted = [file for file in self.previous if not file in self.hashes]
+        if len(self.previous) > 0:
+            with open(model_path + 'documents_dict.json','r',encoding='utf-8') as f:
+                self.previous_documents = json.load(f)
+            with open(model_path + 'segments_dict.json','r',encoding='utf-8') as f:
+                self.previous_segments = json.load(f)
+            with open(model_path + 'encoded_segments.json','r',encoding='utf-8') as f:
+                self.previous_rows = {segment_id:row for row,segment_id in enumerate(json.load(f))}
+            # Memory-mapped so that only reused rows are read. The mapping keeps the previous file readable after
+            # encode_segments() replaces segment_encodings.npy (POSIX)
+            self.previous_encodings = np.load(model_path + 'segment_encodings.npy',mmap_mode='r')
+            print(f'Incremental update: {len(self.changed)} new or changed files, {len(deleted)} deleted files, '
+                  f'{len(files) - len(self.changed)} unchanged files.')
+
+    def add(self,file,documents=[],segments=[],errors=[]):
+        """
+        Record the documents, segments, and errors produced by a new or changed file.
+        param file: Source file name.
+        param documents: List of document IDs.
+        param segments: List of segment IDs.
+        param errors: List of error tuples.
+        """
+        if not file in self.fresh:
+            self.fresh[file] = {'documents':[],'segments':[],'errors':[]}
+        self.fresh[file]['documents'].extend(documents)
+        self.fresh[file]['segments'].extend(segments)
+        self.fresh[file]['errors'].extend(errors)
+
+    def merge(self,documents_dict,segments_dict,error_list=None):
+        """
+        Merge the processed files with the unchanged files of the previous model in source file order.
+        param documents_dict: Documents of the new or changed files.
+        param segments_dict: Segments of the new or changed files.
+        param error_list: Optional errors of the new or changed files, which are replaced by the merged errors.
+        return: Tuple of merged documents and segments dictionaries
+        """
+        merged_documents = {}
+        merged_segments = {}
+        merged_errors = []
+        for file in self.files:
+            if file in self.changed:
+                entry = self.fresh.get(file,{'documents':[],'segments':[],'errors':[]})
+                documents,segments = documents_dict,segments_dict
+            else:
+                entry = self.previous[file]
+                documents,segments = self.previous_documents,self.previous_segments
+            for document_id in entry['documents']:
+                merged_documents[document_id] = documents[document_id]
+            for segment_id in entry['segments']:
+                merged_segments[segment_id] = segments[segment_id]
+            merged_errors.extend([tuple(error) for error in entry['errors']])
+            self.manifest[file] = {'hash':self.hashes[file],'documents':list(entry['documents']),\
+                                   'segments':list(entry['segments']),'errors':list(entry['errors'])}
+        if error_list is not None:
+            error_list[:] = merged_errors
+        return merged_documents,merged_segments
+
+    def lookup(self,segment_id,text):
+        """
+        Get the previous encoding of a segment if its text is unchanged.
+        param segment_id: Segment ID.
+        param text: Segment text.
+        return: Encoding vector or None
+        """
+        row = self.previous_rows.get(segment_id)
+        if row is None or self.previous_segments[segment_id]['text'] != text:
+            return None
+        return self.previous_encodings[row]
+
+    def save(self):
+        """
+        Write manifest.json. Called once the model files have been written so that an interrupted run
+        never leaves a manifest that describes files it did not write.
+        """
+        with open(self.model_path + 'manifest.json','w',encoding='utf-8') as f:
+            json.dump({'signature':self.signature,'files':self.manifest},f)
+
+def normalise_rows(matrix):
+    """
+    Normalise the rows of a matrix to unit length.
+    param matrix: A matrix of encodings.
+    return: A float32 matrix of unit vectors
+    """
+    matrix = np.asarray(matrix,dtype=np.float32)
+    norms = np.linalg.norm(matrix,axis=1,keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+def build_ann_index(model_path,list_count=0,iterations=10,sample_size=100000,block_size=65536,seed=0):
+    """
+    Build an inverted-file (IVF) index over the segment encodings for similarity range queries and write it
+    to ann_index.npz. Centroids are found by spherical k-means on a sample of the encodings and every segment
+    is then assigned to its nearest centroid. Each list records the smallest cosine similarity between its
+    centroid and a member so that queries can skip lists that cannot contain a match.
+    param model_path: Path to the model files including segment_encodings.npy.
+    param list_count: Number of lists. If 0 the square root of the number of segments is used.
+    param iterations: Number of k-means iterations.
+    param sample_size: Maximum number of segments used to train the centroids.
+    param block_size: Number of segments assigned at a time.
+    param seed: Random seed for sampling.
+    """
+    print('Building ANN index…')
+    encodings = np.load(model_path + 'segment_encodings.npy',mmap_mode='r')
+    n = len(encodings)
+    if list_count <= 0:
+        list_count = int(np.sqrt(n))
+    list_count = max(1,min(list_count,n))
+
+    rng = np.random.default_rng(seed)
+    sample = np.sort(rng.choice(n,size=min(n,sample_size),replace=False))
+    vectors = normalise_rows(encodings[sample])
+    centroids = vectors[rng.choice(len(vectors),size=list_count,replace=False)]
+    for _ in range(iterations):
+        assignments = np.argmax(vectors @ centroids.T,axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums,assignments,vectors)
+        norms = np.linalg.norm(sums,axis=1)
+        # Empty lists keep their previous centroid
+        nonempty = norms > 0
+        centroids[nonempty] = sums[nonempty] / norms[nonempty,None]
+
+    assignments = np.empty(n,dtype=np.int64)
+    min_cosines = np.ones(list_count,dtype=np.float32)
+    for start in range(0,n,block_size):
+        cosines = normalise_rows(encodings[start:start + block_size]) @ centroids.T
+        block_assignments = np.argmax(cosines,axis=1)
+        assignments[start:start + block_size] = block_assignments
+        np.minimum.at(min_cosines,block_assignments,cosines[np.arange(len(cosines)),block_assignments])
+
+    order = np.argsort(assignments,kind='stable')
+    offsets = np.searchsorted(assignments[order],np.arange(list_count + 1))
+    np.savez(model_path + 'ann_index.npz',centroids=centroids,order=order,offsets=offsets,min_cosines=min_cosines)
+
+def build_neighbour_graph(model_path,min_threshold=0.58,block_size=4096,memory_limit=256 * 1024 * 1024,\
+                          max_bytes=2 * 1024 * 1024 * 1024):
+    """
+    Precompute every pair of distinct segments whose angular similarity is at or above min_threshold and write them
+    to neighbour_graph.npz as a CSR matrix of cosine similarities. Angular similarity is 1 - arccos(cosine)/pi so the
+    threshold is applied in cosine space. The encodings are memory-mapped and scored in tiles of block_size rows by
+    as many columns as fit in memory_limit, so the corpus is never loaded in full. Self pairs are not stored.
+    The number of pairs grows quickly as the threshold falls, so the build stops without writing a graph if the
+    graph would be larger than max_bytes. SAT expansion then scans the corpus as it does without a graph.
+    param model_path: Path to the model files including segment_encodings.npy.
+    param min_threshold: Lowest angular similarity stored, which should match the lowest slider threshold.
+    param block_size: Number of rows scored at a time.
+    param memory_limit: Approximate size in bytes of the similarities computed at a time.
+    param max_bytes: Largest graph written, in bytes.
+    return: The number of pairs in the graph or None if the graph was too large
+    """
+    print('Building neighbour graph…')
+    filename = model_path + 'neighbour_graph.npz'
+    encodings = np.load(model_path + 'segment_encodings.npy',mmap_mode='r')
+    n = len(encodings)
+    cos_threshold = np.cos(np.pi * (1.0 - min_threshold))
+
+    # Norms are computed in blocks so that the memory-mapped matrix is never copied in full
+    inverse_norms = np.empty(n,dtype=np.float32)
+    for start in range(0,n,65536):
+        block = np.asarray(encodings[start:start + 65536],dtype=np.float32)
+        norms = np.sqrt(np.einsum('ij,ij->i',block,block))
+        norms[norms == 0] = 1.0
+        inverse_norms[start:start + 65536] = 1.0 / norms
+    columns_per_tile = max(1,memory_limit // (4 * block_size))
+
+    indptr = [np.zeros(1,dtype=np.int64)]
+    indices = []
+    data = []
+    pair_count = 0
+    # CSR row pointers, int32 column indices, and float32 cosines
+    index_bytes = (n + 1) * 8
+    for start in range(0,n,block_size):
+        stop = min(start + block_size,n)
+        block = np.asarray(encodings[start:stop],dtype=np.float32) * inverse_norms[start:stop,None]
+        block_rows = []
+        block_cols = []
+        block_data = []
+        for column_start in range(0,n,columns_per_tile):
+            column_stop = min(column_start + columns_per_tile,n)
+            tile = np.asarray(encodings[column_start:column_stop],dtype=np.float32) * \
+                   inverse_norms[column_start:column_stop,None]
+            cosines = block @ tile.T
+            rows,cols = np.nonzero(cosines >= cos_threshold)
+            cosines = cosines[rows,cols]
+            cols = cols + column_start
+            keep = rows + start != cols
+            block_rows.append(rows[keep])
+            block_cols.append(cols[keep])
+            block_data.append(cosines[keep])
+        rows = np.concatenate(block_rows)
+        cols = np.concatenate(block_cols)
+        order = np.lexsort((cols,rows))
+        indices.append(cols[order].astype(np.int32))
+        data.append(np.concatenate(block_data)[order].astype(np.float32))
+        indptr.append(indptr[-1][-1] + np.cumsum(np.bincount(rows,minlength=stop - start)))
+        pair_count += len(rows)
+        if index_bytes + pair_count * 8 > max_bytes:
+            print(f'The neighbour graph exceeds {max_bytes / 1e6:.0f} MB after {stop} of {n} segments '\
+                  f'({pair_count} pairs) and was not written. Raise min_threshold or max_bytes.')
+            if os.path.exists(filename):
+                # A graph from an earlier build would no longer match the encodings
+                os.remove(filename)
+            return None
+
+    graph = csr_matrix((np.concatenate(data),np.concatenate(indices),np.concatenate(indptr)),shape=(n,n))
+    np.savez(filename,data=graph.data,indices=graph.indices,indptr=graph.indptr,\
+             shape=np.array(graph.shape),min_threshold=min_threshold)
+    print(f'Neighbour graph has {graph.nnz} pairs, {graph.nnz / max(n,1):.1f} per segment, '\
+          f'{(index_bytes + graph.nnz * 8) / 1e6:.1f} MB.')
+    return graph.nnz
+
+def remove_model_files(model_path,filenames):
+    """
+    Remove optional model files that exist, e.g., files built from encodings that are about to be rewritten, so that
+    the analysis library never loads them with encodings they don't match.
+    param model_path: Path to the model files.
+    param filenames: List of file names in model_path.
+    """
+    for filename in filenames:
+        if os.path.exists(model_path + filename):
+            os.remove(model_path + filename)
+
+def quantise_encodings(model_path,quantisation='int8',block_size=65536):
+    """
+    Write a reduced-precision copy of the unit-normalised segment encodings to segment_encodings_q.npy.
+    With 'int8' each row is scaled so its largest component maps to 127, giving a quarter of the float32 size.
+    With 'float16' rows are rounded to half precision. segment_encodings_q_parameters.npy holds a row per segment
+    with the scale, the length of the quantisation error, and the norm of the full-precision encoding. The error
+    bounds the difference between approximate and exact cosines so that a search can rescore only the segments
+    that could be above threshold and return exactly the full-precision results.
+    param model_path: Path to the model files including segment_encodings.npy.
+    param quantisation: 'int8' or 'float16'.
+    param block_size: Number of rows quantised at a time.
+    """
+    if not quantisation in ['int8','float16']:
+        raise ValueError(f"Unknown quantisation '{quantisation}'. Use 'int8' or 'float16'.")
+    print(f'Quantising encodings to {quantisation}…')
+    encodings = np.load(model_path + 'segment_encodings.npy',mmap_mode='r')
+    n,dimensions = encodings.shape
+    quantised = np.lib.format.open_memmap(model_path + 'segment_encodings_q.npy',mode='w+',\
+                                          dtype=np.dtype(quantisation),shape=(n,dimensions))
+    parameters = np.empty((n,3),dtype=np.float32)
+    for start in range(0,n,block_size):
+        block = np.asarray(encodings[start:start + block_size],dtype=np.float32)
+        # Norms are computed exactly as the analysis similarity engine computes them
+        norms = np.sqrt(np.einsum('ij,ij->i',block,block))
+        norms[norms == 0] = 1.0
+        unit = block / norms[:,None]
+        if quantisation == 'int8':
+            scales = np.abs(unit).max(axis=1) / 127.0
+            scales[scales == 0] = 1.0
+            q = np.clip(np.rint(unit / scales[:,None]),-127,127).astype(np.int8)
+        else:
+            scales = np.ones(len(unit),dtype=np.float32)
+            q = unit.astype(np.float16)
+        errors = np.linalg.norm(unit.astype(np.float64) - q.astype(np.float64) * scales[:,None],axis=1)
+        quantised[start:start + block_size] = q
+        parameters[start:start + block_size,0] = scales
+        parameters[start:start + block_size,1] = errors
+        parameters[start:start + block_size,2] = norms
+    quantised.flush()
+    del quantised
+    np.save(model_path + 'segment_encodings_q_parameters.npy',parameters)
+
 def xlsx_to_rows_list(xlsx_file):
     """
     Convert XLSX file into a list of dictionaries with one dictionary per row.